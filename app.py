@@ -1,8 +1,14 @@
 import json
 import os
+import atexit
+import multiprocessing
 import pymongo # Make sure this is imported if used by flow_analyzer globally
 import uuid # For generating unique filenames (optional but good practice)
-from flask import Flask, request, Response
+import cv2
+import numpy as np
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Request, current_app, request, Response
 from werkzeug.utils import secure_filename
 from flask_cors import CORS
 
@@ -10,22 +16,94 @@ from flask_cors import CORS
 from src.document_rag import retrieve_documents # Assuming this function exists
 from src.flow_analyzer import flowAnalyzerPipeline
 from src.answer_evaluation import inference_answer_evaluation # Assuming this function exists
-from src.face_monitoring_inference import face_image_inference, face_analysis # Assuming these exist
+from src.face_monitoring_inference import face_image_inference, face_analysis, face_analysis_batch # Assuming these exist
+from src.face_video_review import submit_recording_review, recording_review
+from src.face_inference_workers import FaceInferenceWorkerPool, FaceInferenceTimeout, FaceInferenceOverloaded
+import bson.errors
+
+
+class RecordingUploadRequest(Request):
+    # Werkzeug caps the body stream at max_content_length, chunked uploads included
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'api_face_monitoring_recording':
+            return current_app.config['MAX_RECORDING_LENGTH']
+        return current_app.config['MAX_CONTENT_LENGTH']
+
 
 app = Flask(__name__)
+app.request_class = RecordingUploadRequest
 app.config['UPLOAD_IMAGE_FOLDER'] = 'store/images'
 app.config['UPLOAD_AUDIO_FOLDER'] = 'store/audios'
 app.config['UPLOAD_CV_FOLDER'] = 'store/cvs'
+app.config['UPLOAD_VIDEO_FOLDER'] = 'store/videos'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Example: 16MB upload limit
+# Exam recordings are far larger, only their route gets this limit (see RecordingUploadRequest);
+# Werkzeug spools the upload to a temporary file, not memory
+app.config['MAX_RECORDING_LENGTH'] = int(os.environ.get('MAX_RECORDING_LENGTH', 2 * 1024 * 1024 * 1024))
+# Webcam frames are processed in memory; set PERSIST_FACE_FRAMES=1 to also keep a copy under store/images
+app.config['PERSIST_FACE_FRAMES'] = os.environ.get('PERSIST_FACE_FRAMES', '0') == '1'
+# FACE_INFERENCE_WORKERS > 0 moves face inference out of the request thread into that many worker processes
+app.config['FACE_INFERENCE_WORKERS'] = int(os.environ.get('FACE_INFERENCE_WORKERS', '0'))
+app.config['FACE_INFERENCE_DEADLINE'] = float(os.environ.get('FACE_INFERENCE_DEADLINE', '5'))
+app.config['FACE_INFERENCE_STARTUP_TIMEOUT'] = float(os.environ.get('FACE_INFERENCE_STARTUP_TIMEOUT', '300'))
 
 # Ensure upload directories exist
-for folder_key in ['UPLOAD_IMAGE_FOLDER', 'UPLOAD_AUDIO_FOLDER', 'UPLOAD_CV_FOLDER']:
+for folder_key in ['UPLOAD_IMAGE_FOLDER', 'UPLOAD_AUDIO_FOLDER', 'UPLOAD_CV_FOLDER', 'UPLOAD_VIDEO_FOLDER']:
     if not os.path.exists(app.config[folder_key]):
         os.makedirs(app.config[folder_key])
         print(f"Created directory: {app.config[folder_key]}")
 
 CORS(app, origins="http://localhost:5173") # Adjust origins for production
 
+# Single background writer so persisting frames never adds disk latency to a request
+frame_writer = ThreadPoolExecutor(max_workers=1)
+
+
+def start_face_worker_pool():
+    pool = FaceInferenceWorkerPool(
+        app.config['FACE_INFERENCE_WORKERS'],
+        default_deadline=app.config['FACE_INFERENCE_DEADLINE']
+    )
+    # Workers flush their event buffers on close(); daemonic ones are killed at exit otherwise
+    atexit.register(pool.close)
+    # Frames would only time out while the workers load their models, so wait for them here
+    if pool.wait_ready(timeout=app.config['FACE_INFERENCE_STARTUP_TIMEOUT']):
+        print(f"{pool.n_workers} face inference workers ready")
+    else:
+        print(f"Face inference workers not ready after {app.config['FACE_INFERENCE_STARTUP_TIMEOUT']}s: {pool.metrics()}")
+    return pool
+
+
+# Spawned workers re-import this module, only the parent process starts the pool
+face_worker_pool = None
+if app.config['FACE_INFERENCE_WORKERS'] > 0 and multiprocessing.parent_process() is None:
+    face_worker_pool = start_face_worker_pool()
+
+
+def get_face_worker_pool():
+    return face_worker_pool
+
+
+@app.before_request
+def limit_request_length():
+    # Reject a declared oversized body up front with JSON instead of Werkzeug's HTML 413
+    if (request.content_length or 0) > request.max_content_length:
+        return Response(
+            response=json.dumps({"message": "Request body too large"}),
+            status=413,
+            mimetype="application/json"
+        )
+    return None
+
+
+def persist_frame(image_bytes, save_path):
+    try:
+        with open(save_path, 'wb') as f:
+            f.write(image_bytes)
+    except Exception as e:
+        app.logger.error(f"Persisting face frame to {save_path} failed: {str(e)}")
+
 
 @app.route('/api/face_detection', methods=['POST'])
 def api_face_detection():
@@ -45,20 +123,44 @@ def api_face_detection():
             mimetype="application/json"
         )
 
-    # Generate a unique filename
-    original_filename = secure_filename(image_file.filename)
-    filename_stem, file_ext = os.path.splitext(original_filename)
-    unique_filename = f"{filename_stem}_{uuid.uuid4().hex}{file_ext}"
-    save_path = os.path.join(app.config['UPLOAD_IMAGE_FOLDER'], unique_filename)
-    
+    image_bytes = image_file.read()
+    image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return Response(
+            response=json.dumps({"message": "Image file could not be decoded"}),
+            status=400,
+            mimetype="application/json"
+        )
+
+    if app.config['PERSIST_FACE_FRAMES']:
+        original_filename = secure_filename(image_file.filename)
+        filename_stem, file_ext = os.path.splitext(original_filename)
+        unique_filename = f"{filename_stem}_{uuid.uuid4().hex}{file_ext}"
+        save_path = os.path.join(app.config['UPLOAD_IMAGE_FOLDER'], unique_filename)
+        frame_writer.submit(persist_frame, image_bytes, save_path)
+
     try:
-        image_file.save(save_path)
-        head_pose_text, det_username = face_image_inference(username, save_path)
+        if app.config['FACE_INFERENCE_WORKERS'] > 0:
+            head_pose_text, det_username = get_face_worker_pool().infer(username, image)
+        else:
+            head_pose_text, det_username = face_image_inference(username, image)
         return Response(
             response=json.dumps({"Head Pose": head_pose_text, "Username": det_username}),
             status=200,
             mimetype="application/json"
         )
+    except FaceInferenceOverloaded as e:
+        return Response(
+            response=json.dumps({"message": "Face detection is overloaded, retry later", "error": str(e)}),
+            status=503,
+            mimetype="application/json"
+        )
+    except FaceInferenceTimeout as e:
+        return Response(
+            response=json.dumps({"message": "Face detection timed out", "error": str(e)}),
+            status=504,
+            mimetype="application/json"
+        )
     except Exception as e:
         app.logger.error(f"Face detection failed: {str(e)}", exc_info=True)
         return Response(
@@ -66,9 +168,19 @@ def api_face_detection():
             status=500,
             mimetype="application/json"
         )
-    finally:
-        if os.path.exists(save_path): # Optional: clean up if image not needed after processing
-             pass # os.remove(save_path) 
+
+
+@app.route('/api/face_workers/metrics', methods=['GET'])
+def api_face_workers_metrics():
+    if app.config['FACE_INFERENCE_WORKERS'] <= 0:
+        metrics = {"workers": 0, "mode": "inline"}
+    else:
+        metrics = get_face_worker_pool().metrics()
+    return Response(
+        response=json.dumps(metrics),
+        status=200,
+        mimetype="application/json"
+    )
 
 
 @app.route('/api/face_monitoring', methods=['POST'])
@@ -96,6 +208,150 @@ def api_face_monitoring():
         )
 
 
+@app.route('/api/face_monitoring/batch', methods=['POST'])
+def api_face_monitoring_batch():
+    # JSON body or form fields; usernames may be a list or a comma-separated string
+    data = request.get_json(silent=True) or request.form
+    usernames = data.get('usernames')
+    if isinstance(usernames, str):
+        usernames = [username.strip() for username in usernames.split(',') if username.strip()]
+    course_id = data.get('course_id')
+
+    if not usernames and not course_id:
+        return Response(
+            response=json.dumps({"message": "usernames or course_id missing"}),
+            status=400,
+            mimetype="application/json"
+        )
+    try:
+        x_min = int(data.get('x_min', 10))
+        page = int(data.get('page', 1))
+        page_size = int(data['page_size']) if data.get('page_size') not in (None, '') else None
+    except (TypeError, ValueError):
+        return Response(
+            response=json.dumps({"message": "x_min, page and page_size must be integers"}),
+            status=400,
+            mimetype="application/json"
+        )
+    # A negative page_size would slice from the wrong end, a non-positive x_min counts nothing
+    if x_min < 1 or page < 1 or (page_size is not None and page_size < 1):
+        return Response(
+            response=json.dumps({"message": "x_min, page and page_size must be at least 1"}),
+            status=400,
+            mimetype="application/json"
+        )
+
+    try:
+        response_data = face_analysis_batch(
+            usernames=usernames,
+            course_id=course_id,
+            x_min=x_min,
+            page=page,
+            page_size=page_size
+        )
+        return Response(
+            response=json.dumps(response_data),
+            status=200,
+            mimetype="application/json"
+        )
+    except bson.errors.InvalidId:
+        return Response(
+            response=json.dumps({"message": "Invalid course_id format"}),
+            status=400,
+            mimetype="application/json"
+        )
+    except Exception as e:
+        app.logger.error(f"Batch face monitoring failed: {str(e)}", exc_info=True)
+        return Response(
+            response=json.dumps({"message": "Batch face monitoring failed", "error": str(e)}),
+            status=500,
+            mimetype="application/json"
+        )
+
+
+@app.route('/api/face_monitoring/recording', methods=['POST'])
+def api_face_monitoring_recording():
+    username = request.form.get('username')
+    video_file = request.files.get('video_file')
+
+    if not username or not video_file or video_file.filename == '':
+        return Response(
+            response=json.dumps({"message": "Username or video_file missing"}),
+            status=400,
+            mimetype="application/json"
+        )
+    try:
+        sample_fps = float(request.form.get('sample_fps', 2))
+        recording_start = request.form.get('recording_start')
+        if recording_start:
+            recording_start = datetime.fromisoformat(recording_start)
+            if recording_start.tzinfo is None:
+                recording_start = recording_start.replace(tzinfo=timezone.utc)
+    except ValueError:
+        return Response(
+            response=json.dumps({"message": "sample_fps must be a number and recording_start an ISO 8601 datetime"}),
+            status=400,
+            mimetype="application/json"
+        )
+    if sample_fps <= 0:
+        return Response(
+            response=json.dumps({"message": "sample_fps must be positive"}),
+            status=400,
+            mimetype="application/json"
+        )
+
+    filename = f"{uuid.uuid4().hex}_{secure_filename(video_file.filename)}"
+    save_path = os.path.join(app.config['UPLOAD_VIDEO_FOLDER'], filename)
+    try:
+        video_file.save(save_path)
+        # reviewed in the background, the video is deleted once the review ends
+        recording_id = submit_recording_review(
+            username,
+            save_path,
+            sample_fps=sample_fps,
+            recording_start=recording_start or None
+        )
+        return Response(
+            response=json.dumps({"recording_id": recording_id, "status": "queued"}),
+            status=202,
+            mimetype="application/json"
+        )
+    except Exception as e:
+        if os.path.exists(save_path):
+            os.remove(save_path)
+        app.logger.error(f"Queueing recording face monitoring failed: {str(e)}", exc_info=True)
+        return Response(
+            response=json.dumps({"message": "Recording face monitoring failed", "error": str(e)}),
+            status=500,
+            mimetype="application/json"
+        )
+
+
+@app.route('/api/face_monitoring/recording/<recording_id>', methods=['GET'])
+def api_face_monitoring_recording_status(recording_id):
+    try:
+        review = recording_review(recording_id)
+    except Exception as e:
+        app.logger.error(f"Reading recording review {recording_id} failed: {str(e)}", exc_info=True)
+        return Response(
+            response=json.dumps({"message": "Reading recording review failed", "error": str(e)}),
+            status=500,
+            mimetype="application/json"
+        )
+    if review is None:
+        return Response(
+            response=json.dumps({"message": "Unknown recording_id"}),
+            status=404,
+            mimetype="application/json"
+        )
+    # status, timestamps and, once done, the report recorded_video_face_inference returns
+    return Response(
+        response=json.dumps(review, default=str),
+        status=200,
+        mimetype="application/json"
+    )
+
+
 @app.route('/api/flow_analyzer', methods=['POST'])
 def api_flow_analyzer():
     user_id = request.form.get('userId')
@@ -16,6 +16,8 @@ import bson.errors # <<< --- ADD THIS IMPORT
 from auth_utils import (
     register_student_user,
     register_company_user,
+    update_student_image,
+    get_face_enrollment_status,
     verify_password,
     users_collection,
     client, # Assuming client is your MongoClient instance from auth_utils
@@ -77,6 +79,29 @@ def register_student():
 def register_company():
     return register_company_user(app.config)
 
+@app.route('/me/profile_image', methods=['PUT'])
+@jwt_required()
+def update_profile_image():
+    return update_student_image(app.config, get_jwt_identity())
+
+@app.route('/students/<username>/face_enrollment', methods=['GET'])
+@jwt_required()
+def face_enrollment_status(username):
+    claims = get_jwt()
+    requesting_user_email = get_jwt_identity()
+    requesting_user_role = claims.get('role')
+
+    if requesting_user_role == 'student':
+        actor_user_doc = users_collection.find_one({"email": requesting_user_email}, {"username": 1})
+        if (not actor_user_doc) or (actor_user_doc.get('username') != username):
+            logger.warning(f"Auth fail: Student {requesting_user_email} tried to read the face enrollment of {username}")
+            return jsonify({"msg": "Unauthorized: You can only view your own face enrollment."}), 403
+    elif requesting_user_role not in ['admin', 'company']:
+        logger.warning(f"Auth fail: Role {requesting_user_role} ({requesting_user_email}) tried to read the face enrollment of {username}")
+        return jsonify({"msg": "Unauthorized role to view face enrollments."}), 403
+
+    return get_face_enrollment_status(username)
+
 
 @app.route('/login', methods=['POST'])
 def login():
@@ -10,6 +10,7 @@ from werkzeug.utils import secure_filename
 import time
 import random
 import string
+from src.face_enrollment_jobs import get_face_enrollment_queue, FACE_ENROLLMENT_CONFLICTS_COLLECTION
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -67,6 +68,33 @@ def verify_password(password, password_hash):
     """Verifies a password against its hash."""
     return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
 
+def flag_face_enrollment_conflict(username, user_id, image_path):
+    """Records an enrollment that was refused because the username is not unique, for staff to resolve by hand."""
+    logger.warning(f"Face enrollment of user {user_id} refused: username '{username}' is held by another account")
+    db[FACE_ENROLLMENT_CONFLICTS_COLLECTION].insert_one({
+        "username": username,
+        "user_id": user_id,
+        "image_path": image_path,
+        "flagged_at": datetime.datetime.utcnow()
+    })
+
+
+def enqueue_face_enrollment(username, image_path, user_id, replace=False):
+    """Queues a profile image for face enrollment. Never fails the calling request."""
+    try:
+        # faces are indexed by username, which is firstname+lastname and can belong to several accounts
+        if users_collection.find_one({'username': username, '_id': {'$ne': user_id}}, {'_id': 1}):
+            flag_face_enrollment_conflict(username, user_id, image_path)
+            return False
+        queued = get_face_enrollment_queue(db).submit(username, image_path, user_id=user_id, replace=replace)
+        if queued is None:
+            flag_face_enrollment_conflict(username, user_id, image_path)
+            return False
+        return queued
+    except Exception as e:
+        logger.error(f"Could not queue face enrollment for {username}: {e}", exc_info=True)
+        return False
+
 def register_student_user(app_config):
     """Handles student user registration logic with image upload and username in users collection."""
     email = request.form.get('email')
@@ -133,6 +161,9 @@ def register_student_user(app_config):
 
         if user_result.acknowledged and student_result.acknowledged:
             logger.info(f"Student '{student_username}' with email {email} registered successfully. User ID: {user_id_obj}")
+            if actual_image_save_path:
+                # embedded and indexed in the background, see GET /students/<username>/face_enrollment
+                enqueue_face_enrollment(student_username, actual_image_save_path, user_id_obj)
             return jsonify({"msg": "Student registered successfully"}), 201
         else:
             logger.error(f"Student registration failed: Insert operation not fully acknowledged for email {email}")
@@ -149,6 +180,56 @@ def register_student_user(app_config):
         return jsonify({"msg": "Student registration failed due to a server error"}), 500
 
 
+def update_student_image(app_config, email):
+    """Replaces the profile image of the student with this email and re-enrolls their face."""
+    image_file = request.files.get('image')
+    if not image_file or image_file.filename == '':
+        return jsonify({"msg": "Missing image"}), 400
+
+    try:
+        user = users_collection.find_one({'email': email, 'role': 'student'})
+        if not user:
+            return jsonify({"msg": "Student not found"}), 404
+        student_username = user['username']
+
+        upload_folder = app_config['UPLOAD_IMAGE_FOLDER']
+        file_extension = os.path.splitext(image_file.filename)[1]
+        timestamp = str(int(time.time()))
+        random_chars = ''.join(random.choices(string.ascii_lowercase + string.digits, k=4))
+        filename = secure_filename(f"profile_{student_username}_{timestamp}_{random_chars}{file_extension}")
+        actual_image_save_path = os.path.join(upload_folder, filename)
+        image_file.save(actual_image_save_path)
+        image_filepath_for_db = "/store/images/" + filename
+
+        students_collection.update_one({'user_id': user['_id']}, {'$set': {'image': image_filepath_for_db}})
+        logger.info(f"Profile image of student {email} updated to {image_filepath_for_db}")
+
+        enqueue_face_enrollment(student_username, actual_image_save_path, user['_id'], replace=True)
+        return jsonify({"msg": "Profile image updated", "image": image_filepath_for_db}), 200
+
+    except errors.PyMongoError as e:
+        logger.error(f"MongoDB error updating profile image for {email}: {e}")
+        return jsonify({"msg": f"Database error: {str(e)}"}), 500
+    except Exception as e:
+        logger.error(f"Unexpected error updating profile image for {email}: {e}", exc_info=True)
+        return jsonify({"msg": "Profile image update failed due to a server error"}), 500
+
+
+def get_face_enrollment_status(username):
+    """Returns the face enrollment status of a student."""
+    try:
+        status = get_face_enrollment_queue(db).status(username)
+        if not status:
+            return jsonify({"username": username, "status": "not_enrolled"}), 200
+        for key in ('requested_at', 'updated_at', 'enrolled_at'):
+            if status.get(key):
+                status[key] = status[key].isoformat()
+        return jsonify(status), 200
+    except errors.PyMongoError as e:
+        logger.error(f"MongoDB error reading face enrollment status for {username}: {e}")
+        return jsonify({"msg": f"Database error: {str(e)}"}), 500
+
+
 def register_company_user(app_config):
     """Handles company user registration logic with image upload and username in users collection."""
     email = request.form.get('email')
@@ -232,6 +313,8 @@ def register_company_user(app_config):
 __all__ = [
     'register_student_user',
     'register_company_user',
+    'update_student_image',
+    'get_face_enrollment_status',
     'verify_password',
     'users_collection',
     'client',
@@ -0,0 +1,107 @@
+import os
+import glob
+import time
+import platform
+import argparse
+import numpy as np
+import cv2 as cv
+from src.face_index import FACE_DETECTOR_BACKENDS
+from src.face_monitoring_inference import (
+                                            detect_faces,
+                                            embed_faces,
+                                            identify_faces,
+                                            get_face_index_manager,
+                                            )
+
+DETECTORS = ["facemesh"] + FACE_DETECTOR_BACKENDS
+
+def frame_identity(faces, min_confidence = 0.5):
+    """Identity of the largest face, the way a single-candidate frame is judged; None when nobody is recognized."""
+    if len(faces) == 0:
+        return None
+    face = max(faces, key = lambda face: face["facial_area"][2] * face["facial_area"][3])
+    identify_faces(embed_faces([face]))
+    if (face.get("det_username") is None) or (face["match_confidence"] < min_confidence):
+        return None
+    return face["det_username"]
+
+def run_detector(
+                detector,
+                frames,
+                warmup = 3
+                ):
+    # the first calls load the detector weights
+    for _, image in frames[:warmup]:
+        detect_faces(image, detector_backend = detector)
+
+    latencies, found, identities = [], [], []
+    for _, image in frames:
+        start = time.perf_counter()
+        faces = detect_faces(image, detector_backend = detector)
+        latencies.append(time.perf_counter() - start)
+        found.append(len(faces) > 0)
+        identities.append(frame_identity(faces))
+    return np.asarray(latencies), np.asarray(found), identities
+
+def benchmark_detectors(
+                        frame_paths,
+                        detectors = DETECTORS,
+                        reference = "facemesh",
+                        warmup = 3
+                        ):
+    """
+    Replay `frame_paths` through every detector. Latency is the detection
+    pass, including the FaceMesh pose every backend needs. Identity
+    agreement is measured against `reference`, over frames where both found
+    someone. Frames stored as <username>/<frame>.jpg also give an accuracy
+    against that label.
+    """
+    frames = [(path, cv.imread(path)) for path in frame_paths]
+    frames = [(path, image) for path, image in frames if image is not None]
+    if len(frames) == 0:
+        raise ValueError("No readable frames")
+    # folder names count as labels only when they are enrolled users
+    enrolled = set(str(name) for name in get_face_index_manager().get().identities)
+    labels = [os.path.basename(os.path.dirname(path)) for path, _ in frames]
+    labels = [label if label in enrolled else None for label in labels]
+    print(f"{len(frames)} frames, {platform.machine()} {platform.processor() or ''} with {os.cpu_count()} CPUs")
+
+    results = {}
+    for detector in detectors:
+        try:
+            results[detector] = run_detector(detector, frames, warmup = warmup)
+        except Exception as e:
+            # e.g. mtcnn or retinaface not installed on this host
+            print(f"Skipping {detector} : {e}")
+
+    rows = []
+    reference_identities = results[reference][2] if reference in results else None
+    for detector, (latencies, found, identities) in results.items():
+        row = {
+            "detector": detector,
+            "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+            "p90_ms": round(float(np.percentile(latencies, 90)) * 1000, 2),
+            "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 2),
+            "face_found_rate": round(float(found.mean()), 4),
+            }
+
+        if (reference_identities is not None) and (detector != reference):
+            both = [(a, b) for a, b in zip(identities, reference_identities) if (a is not None) and (b is not None)]
+            row["identity_agreement"] = round(float(np.mean([a == b for a, b in both])), 4) if both else None
+
+        labelled = [(identity, label) for identity, label in zip(identities, labels) if label is not None]
+        row["identity_accuracy"] = round(float(np.mean([identity == label for identity, label in labelled])), 4) if labelled else None
+        rows.append(row)
+        print(row)
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Latency, face-found rate and identity agreement of the face detectors on recorded frames")
+    parser.add_argument('--frames', default = 'data/frames/*/*.jpg', help = "glob of frames, ideally <username>/<frame>.jpg")
+    parser.add_argument('--detectors', nargs = '+', default = DETECTORS, choices = DETECTORS)
+    parser.add_argument('--reference', default = "facemesh", choices = DETECTORS)
+    parser.add_argument('--max_frames', type = int, default = None)
+    args = parser.parse_args()
+
+    frame_paths = sorted(glob.glob(args.frames))[:args.max_frames]
+    benchmark_detectors(frame_paths, detectors = args.detectors, reference = args.reference)
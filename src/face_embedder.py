@@ -0,0 +1,192 @@
+import os
+import sys
+import glob
+import argparse
+import threading
+import numpy as np
+import cv2 as cv
+
+FACE_MODEL_NAME = "Facenet512"
+FACENET512_INPUT_SIZE = (160, 160)
+FACENET512_ONNX_PATH = 'models/facenet512.onnx'
+FACENET512_ONNX_INT8_PATH = 'models/facenet512.int8.onnx'
+
+# deepface (TensorFlow Keras), onnx (float32) or onnx-int8
+FACE_EMBEDDER_BACKEND = os.environ.get("FACE_EMBEDDER_BACKEND", "deepface")
+FACE_EMBEDDER_THREADS = int(os.environ.get("FACE_EMBEDDER_THREADS", "1"))
+
+def preprocess_face(
+                    crop,
+                    target_size = FACENET512_INPUT_SIZE
+                    ):
+    """
+    The input DeepFace.represent(detector_backend="skip") builds from a BGR
+    crop: channels flipped, letterboxed into `target_size` with black
+    padding and scaled to [0, 1].
+    """
+    img = crop[:, :, ::-1]
+    factor = min(target_size[0] / img.shape[0], target_size[1] / img.shape[1])
+    img = cv.resize(img, (int(img.shape[1] * factor), int(img.shape[0] * factor)))
+
+    diff_0 = target_size[0] - img.shape[0]
+    diff_1 = target_size[1] - img.shape[1]
+    img = np.pad(
+                img,
+                ((diff_0 // 2, diff_0 - diff_0 // 2), (diff_1 // 2, diff_1 - diff_1 // 2), (0, 0)),
+                "constant"
+                )
+    if img.shape[0:2] != target_size:
+        img = cv.resize(img, target_size)
+
+    img = img.astype(np.float32)
+    if img.max() > 1:
+        img = img / 255.0
+    return img
+
+class DeepFaceEmbedder:
+    name = "deepface"
+
+    def __init__(self):
+        from deepface import DeepFace
+        self._deepface = DeepFace
+        DeepFace.build_model(FACE_MODEL_NAME)
+
+    def embed(self, crops):
+        embeddings = []
+        for crop in crops:
+            face_objs = self._deepface.represent(
+                                                img_path = crop,
+                                                model_name = FACE_MODEL_NAME,
+                                                detector_backend = "skip",
+                                                enforce_detection = False
+                                                )
+            embeddings.append(face_objs[0]['embedding'])
+        return embeddings
+
+class OnnxFaceEmbedder:
+    """
+    Facenet512 exported to ONNX and run with ONNX Runtime on the CPU. All
+    crops of a frame go through one batched session.run call.
+    """
+
+    def __init__(
+                self,
+                model_path,
+                name = "onnx",
+                intra_op_threads = FACE_EMBEDDER_THREADS
+                ):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, sess_options = options, providers = ["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.name = name
+
+    def embed(self, crops):
+        if len(crops) == 0:
+            return []
+        batch = np.stack([preprocess_face(crop) for crop in crops])
+        embeddings = self.session.run(None, {self.input_name: batch})[0]
+        return [embedding.tolist() for embedding in embeddings]
+
+def export_facenet512_onnx(
+                            onnx_path = FACENET512_ONNX_PATH,
+                            opset = 13
+                            ):
+    import tensorflow as tf
+    import tf2onnx
+    from deepface import DeepFace
+
+    client = DeepFace.build_model(FACE_MODEL_NAME)
+    # newer DeepFace wraps the Keras model in a client object
+    keras_model = getattr(client, "model", client)
+    input_signature = [tf.TensorSpec((None, *FACENET512_INPUT_SIZE, 3), tf.float32, name = "input")]
+
+    os.makedirs(os.path.dirname(onnx_path) or '.', exist_ok = True)
+    tf2onnx.convert.from_keras(keras_model, input_signature = input_signature, opset = opset, output_path = onnx_path)
+    print(f"Exported {FACE_MODEL_NAME} to {onnx_path}")
+    return onnx_path
+
+def quantize_facenet512_onnx(
+                            onnx_path = FACENET512_ONNX_PATH,
+                            int8_path = FACENET512_ONNX_INT8_PATH
+                            ):
+    # weights to int8, activations quantized on the fly, no calibration set needed
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(onnx_path, int8_path, weight_type = QuantType.QInt8)
+    print(f"Quantized {onnx_path} to {int8_path}")
+    return int8_path
+
+def new_face_embedder(backend = None):
+    backend = backend or FACE_EMBEDDER_BACKEND
+    if backend == "deepface":
+        return DeepFaceEmbedder()
+
+    model_path = {"onnx": FACENET512_ONNX_PATH, "onnx-int8": FACENET512_ONNX_INT8_PATH}.get(backend)
+    if model_path is None:
+        raise ValueError(f"Unknown face embedder backend {backend}")
+    if not os.path.exists(model_path):
+        print(f"{model_path} not found, run `python -m src.face_embedder --export` first. Falling back to DeepFace")
+        return DeepFaceEmbedder()
+    return OnnxFaceEmbedder(model_path, name = backend)
+
+face_embedders = {}
+face_embedders_lock = threading.Lock()
+
+def get_face_embedder(backend = None):
+    backend = backend or FACE_EMBEDDER_BACKEND
+    with face_embedders_lock:
+        if backend not in face_embedders:
+            face_embedders[backend] = new_face_embedder(backend)
+        return face_embedders[backend]
+
+def cosine_similarity(a, b):
+    a, b = np.asarray(a, dtype = np.float64), np.asarray(b, dtype = np.float64)
+    return float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+def embedding_parity(
+                    image_paths,
+                    backend = "onnx",
+                    min_cosine = 0.99
+                    ):
+    """
+    Cosine similarity between the DeepFace embedding and the `backend`
+    embedding of each fixture face crop. Returns (passed, similarities).
+    """
+    reference = get_face_embedder("deepface")
+    candidate = get_face_embedder(backend)
+    if candidate.name != backend:
+        raise FileNotFoundError(f"No {backend} model to compare, export it first")
+
+    crops = [cv.imread(image_path) for image_path in image_paths]
+    crops = [crop for crop in crops if crop is not None]
+    if len(crops) == 0:
+        raise ValueError("No readable fixture images")
+
+    similarities = np.array([
+                            cosine_similarity(a, b)
+                            for a, b in zip(reference.embed(crops), candidate.embed(crops))
+                            ])
+    print(f"{backend} vs deepface over {len(crops)} faces : min cosine {similarities.min():.5f}, mean {similarities.mean():.5f}")
+    return bool(similarities.min() >= min_cosine), similarities
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Export, quantize and check the ONNX Facenet512 embedder")
+    parser.add_argument('--export', action = 'store_true', help = f"export Facenet512 to {FACENET512_ONNX_PATH}")
+    parser.add_argument('--quantize', action = 'store_true', help = f"write the int8 model to {FACENET512_ONNX_INT8_PATH}")
+    parser.add_argument('--parity', default = None, choices = ["onnx", "onnx-int8"], help = "compare a backend against DeepFace")
+    parser.add_argument('--fixtures', default = 'data/facedb/*/*.jpg', help = "glob of face crops for the parity check")
+    parser.add_argument('--min_cosine', type = float, default = None, help = "defaults to 0.99 for onnx and 0.95 for onnx-int8")
+    args = parser.parse_args()
+
+    if args.export:
+        export_facenet512_onnx()
+    if args.quantize:
+        quantize_facenet512_onnx()
+    if args.parity:
+        min_cosine = args.min_cosine if args.min_cosine is not None else {"onnx": 0.99, "onnx-int8": 0.95}[args.parity]
+        passed, _ = embedding_parity(sorted(glob.glob(args.fixtures)), backend = args.parity, min_cosine = min_cosine)
+        print("Parity check passed" if passed else f"Parity check FAILED, min cosine below {min_cosine}")
+        sys.exit(0 if passed else 1)
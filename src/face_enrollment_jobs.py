@@ -0,0 +1,192 @@
+import os
+import uuid
+import shutil
+import socket
+import threading
+from datetime import datetime, timedelta, timezone
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from werkzeug.utils import secure_filename
+
+FACE_ENROLLMENTS_COLLECTION = 'face_enrollments'
+# enrollments refused because their username belongs to another account
+FACE_ENROLLMENT_CONFLICTS_COLLECTION = 'face_enrollment_conflicts'
+FACE_DB_DIR = 'data/facedb'
+
+class FaceEnrollmentQueue:
+    """
+    Background enrollment of profile images into the live face index.
+
+    submit() copies the image into data/facedb/<username>/, so offline
+    rebuilds see it as well. It is removed again when no face is enrolled
+    from it, and a replacing job removes the user's older images there only
+    once the new one gave a face. It records the job as "queued" in the
+    face_enrollments collection and returns immediately. The collection is
+    the queue: a worker thread in every process claims one queued job at a
+    time with find_one_and_update, which marks it "processing" under its
+    owner with a lease of `lease_seconds`. A job is therefore enrolled by
+    one process only, and a job whose owner died is claimed again once its
+    lease runs out. The status ends as "enrolled", "no_face" or "failed".
+    Processes serving the index pick the change up on their next file
+    check.
+    """
+
+    def __init__(
+                self,
+                collection,
+                facedb_dir = FACE_DB_DIR,
+                max_queue = 1000,
+                lease_seconds = 300,
+                poll_interval = 5.0
+                ):
+        self.collection = collection
+        self.facedb_dir = facedb_dir
+        self.max_queue = max_queue
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self.collection.create_index("username", unique = True)
+            self.collection.create_index([("status", 1), ("requested_at", 1)])
+            self._thread = threading.Thread(target = self._run, name = "face-enrollment", daemon = True)
+            self._thread.start()
+        return self
+
+    def _prune_user_dir(self, face_image_path, keep_only):
+        # the folder mirrors what is enrolled, so a rebuild neither brings old faces back nor picks up a rejected one
+        user_dir = os.path.dirname(face_image_path)
+        for image in os.listdir(user_dir):
+            image_path = os.path.join(user_dir, image)
+            if (image_path == face_image_path) != keep_only:
+                os.remove(image_path)
+
+    def _finish(self, job, status, **fields):
+        # a job resubmitted or reclaimed meanwhile has another job_id or owner and is left alone
+        self.collection.update_one(
+                                {"username": job["username"], "job_id": job.get("job_id"), "owner": self.owner},
+                                {"$set": {"status": status, "updated_at": datetime.now(timezone.utc), **fields}}
+                                )
+
+    def submit(
+            self,
+            username,
+            image_path,
+            user_id = None,
+            replace = False
+            ):
+        """
+        Queue `image_path` for enrollment under `username`. With `replace` the
+        user's earlier faces are dropped. Returns None, without queueing,
+        when the username's job record belongs to another `user_id`.
+        """
+        if self.collection.find_one({"username": username, "user_id": {"$nin": [user_id, None]}}, {"_id": 1}):
+            return None
+
+        user_dir = os.path.join(self.facedb_dir, secure_filename(username))
+        os.makedirs(user_dir, exist_ok = True)
+        face_image_path = os.path.join(user_dir, os.path.basename(image_path))
+        shutil.copyfile(image_path, face_image_path)
+
+        queued = self.collection.count_documents({"status": "queued"}) < self.max_queue
+        now = datetime.now(timezone.utc)
+        try:
+            # a record of another account with this username makes the upsert collide on the unique index
+            self.collection.update_one(
+                                    {"username": username, "user_id": {"$in": [user_id, None]}},
+                                    {"$set": {
+                                            "user_id": user_id,
+                                            "status": "queued" if queued else "failed",
+                                            "job_id": uuid.uuid4().hex,
+                                            "face_image_path": face_image_path,
+                                            "replace": replace,
+                                            "requested_at": now,
+                                            "updated_at": now,
+                                            "owner": None,
+                                            "lease_until": None,
+                                            "error": None if queued else "Enrollment queue is full"
+                                            }},
+                                    upsert = True
+                                    )
+        except DuplicateKeyError:
+            os.remove(face_image_path)
+            return None
+        if queued:
+            self._wakeup.set()
+        return queued
+
+    def status(self, username):
+        # what a student or staff member may see, not file paths, error text or worker ids
+        return self.collection.find_one(
+                                        {"username": username},
+                                        {"_id": 0, "username": 1, "status": 1, "n_faces": 1, "requested_at": 1, "updated_at": 1, "enrolled_at": 1}
+                                        )
+
+    def claim(self):
+        """The oldest queued job, or one whose owner let its lease run out, now owned by this process. None when there is none."""
+        now = datetime.now(timezone.utc)
+        return self.collection.find_one_and_update(
+                                                {"$or": [
+                                                        {"status": "queued"},
+                                                        {"status": "processing", "lease_until": {"$lt": now}}
+                                                        ]},
+                                                {"$set": {
+                                                        "status": "processing",
+                                                        "owner": self.owner,
+                                                        "lease_until": now + timedelta(seconds = self.lease_seconds),
+                                                        "updated_at": now
+                                                        }},
+                                                sort = [("requested_at", 1)],
+                                                return_document = ReturnDocument.AFTER
+                                                )
+
+    def _run(self):
+        while True:
+            try:
+                job = self.claim()
+            except Exception as e:
+                print(f"Claiming a face enrollment job failed : {e}")
+                job = None
+            if job is None:
+                # woken early by a local submit, jobs queued by other processes wait for the poll
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            username = job["username"]
+            try:
+                # imported here: loading the models and the index is the slow part this thread keeps off the request
+                from src.face_monitoring_inference import enroll_face_in_db
+
+                replace = job.get("replace", False)
+                n_faces = enroll_face_in_db(username, [job["face_image_path"]], replace = replace)
+                if ((not n_faces) or replace) and os.path.exists(job["face_image_path"]):
+                    # on success a replaced user's old images go, without a face the new one does and the old enrollment stays
+                    self._prune_user_dir(job["face_image_path"], keep_only = bool(n_faces))
+                if n_faces:
+                    self._finish(job, "enrolled", n_faces = n_faces, enrolled_at = datetime.now(timezone.utc))
+                else:
+                    self._finish(job, "no_face", error = "No single face found in the image, the previous enrollment is kept")
+            except Exception as e:
+                print(f"Face enrollment of {username} failed : {e}")
+                try:
+                    if os.path.exists(job["face_image_path"]):
+                        self._prune_user_dir(job["face_image_path"], keep_only = False)
+                    self._finish(job, "failed", error = str(e))
+                except Exception as e:
+                    print(f"Recording the failed enrollment of {username} failed : {e}")
+
+face_enrollment_queue = None
+face_enrollment_queue_lock = threading.Lock()
+
+def get_face_enrollment_queue(db):
+    global face_enrollment_queue
+    if face_enrollment_queue is None:
+        with face_enrollment_queue_lock:
+            if face_enrollment_queue is None:
+                face_enrollment_queue = FaceEnrollmentQueue(db[FACE_ENROLLMENTS_COLLECTION]).start()
+    return face_enrollment_queue
@@ -0,0 +1,262 @@
+import time
+import queue
+import atexit
+import threading
+import numpy as np
+import pymongo
+from datetime import datetime, timezone
+from pymongo.errors import OperationFailure, CollectionInvalid
+
+FFEATURES_COLLECTION = 'ffeatures_ts'
+# events of uploaded recordings, kept apart so they never count as live proctoring
+RECORDING_FEATURES_COLLECTION = 'ffeatures_recordings'
+FFEATURES_RAW_TTL_DAYS = 30
+
+def ensure_ffeatures_collection(
+                                db,
+                                name = FFEATURES_COLLECTION,
+                                ttl_days = FFEATURES_RAW_TTL_DAYS
+                                ):
+    """
+    The event collection, created on first use as a time-series collection
+    with exp_username as its meta field, so events of one candidate are
+    bucketed together. Raw events expire after `ttl_days`. Servers older
+    than MongoDB 5.0 get a plain collection with a TTL index instead.
+    """
+    ttl_seconds = int(ttl_days * 24 * 3600)
+    if name not in db.list_collection_names():
+        try:
+            db.create_collection(
+                                name,
+                                timeseries = {
+                                            "timeField": "timestamp",
+                                            "metaField": "exp_username",
+                                            "granularity": "seconds"
+                                            },
+                                expireAfterSeconds = ttl_seconds
+                                )
+        except CollectionInvalid:
+            # created concurrently by another worker
+            pass
+        except OperationFailure as e:
+            print(f"Time-series collections unavailable ({e}), using a TTL-indexed collection for {name}")
+            db[name].create_index("timestamp", expireAfterSeconds = ttl_seconds)
+
+    collection = db[name]
+    collection.create_index([("exp_username", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING)])
+    return collection
+
+class ProctoringEventSink:
+    """
+    Background writer for ffeatures events.
+
+    Request threads hand events to a bounded in-memory queue and return
+    immediately; a single writer thread drains it with insert_many whenever
+    `batch_size` events are waiting or `flush_interval` seconds have passed.
+    When the queue is full, producers block for up to `put_timeout` seconds
+    and the event is dropped (and counted) after that, so a slow database
+    cannot grow memory without bound. Pending events are flushed on close,
+    which is registered to run at interpreter exit.
+    """
+
+    def __init__(
+                self,
+                collection,
+                max_queue = 10000,
+                batch_size = 500,
+                flush_interval = 1.0,
+                put_timeout = 0.5
+                ):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+
+        self._queue = queue.Queue(maxsize = max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.n_written = 0
+        self.n_dropped = 0
+        self.n_failed = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target = self._run, name = "proctoring-event-sink", daemon = True)
+            self._thread.start()
+            atexit.register(self.close)
+        return self
+
+    def put(self, event):
+        try:
+            self._queue.put(event, timeout = self.put_timeout)
+            return True
+        except queue.Full:
+            self.n_dropped += 1
+            if self.n_dropped % 1000 == 1:
+                print(f"Proctoring event queue full, {self.n_dropped} events dropped so far")
+            return False
+
+    def put_many(self, events):
+        return all([self.put(event) for event in events])
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _write(self, batch):
+        try:
+            self.collection.insert_many(batch, ordered = False)
+            self.n_written += len(batch)
+        except Exception as e:
+            self.n_failed += len(batch)
+            print(f"Writing {len(batch)} proctoring events failed : {e}")
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                batch.append(self._queue.get(timeout = max(deadline - time.monotonic(), 0.01)))
+            except queue.Empty:
+                pass
+
+            if (len(batch) >= self.batch_size) or (time.monotonic() >= deadline) or (self._stop.is_set() and self._queue.empty()):
+                if batch:
+                    self._write(batch)
+                    batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+        if batch:
+            self._write(batch)
+
+    def close(self, timeout = 10.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout = timeout)
+
+class RollingProctoringCounters:
+    """
+    Per-user, per-minute event counters (total, detected as self, forward
+    pose) kept as one document per user and minute in the
+    'ffeatures_counters' collection.
+
+    record() only adds the deltas in memory; every `persist_interval`
+    seconds they are $inc'ed into the minute buckets, so any number of
+    processes can count into the same user. A window of up to
+    `window_minutes` minutes is answered by summing at most that many
+    bucket documents plus the deltas this process has not written yet,
+    without touching the raw events. Events counted by other processes
+    show up once they persist, at most `persist_interval` seconds late.
+    Buckets expire after `ttl_days`, like the raw events.
+    """
+
+    def __init__(
+                self,
+                collection = None,
+                window_minutes = 60,
+                persist_interval = 5.0,
+                ttl_days = FFEATURES_RAW_TTL_DAYS
+                ):
+        self.collection = collection
+        self.window_minutes = window_minutes
+        self.persist_interval = persist_interval
+        self.ttl_days = ttl_days
+
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if (self._thread is None) and (self.collection is not None):
+            self.collection.create_index([("exp_username", pymongo.ASCENDING), ("minute", pymongo.ASCENDING)], unique = True)
+            # buckets expire with the raw events they summarize
+            self.collection.create_index("minute", expireAfterSeconds = int(self.ttl_days * 24 * 3600))
+            self._thread = threading.Thread(target = self._run, name = "proctoring-counters", daemon = True)
+            self._thread.start()
+            atexit.register(self.close)
+        return self
+
+    def record(
+            self,
+            username,
+            events
+            ):
+        with self._lock:
+            for event in events:
+                delta = np.array([
+                                1,
+                                int(event["det_username"] == username),
+                                int(event["head_pose"] == "Forward")
+                                ], dtype = np.int64)
+                key = (username, int(event["timestamp"].timestamp() // 60))
+                self._pending[key] = self._pending.get(key, 0) + delta
+
+    def window(
+            self,
+            username,
+            x_min
+            ):
+        """
+        (n_total, n_detected, n_forward) over the last `x_min` minutes, None
+        when the window is longer than `window_minutes` or the buckets cannot
+        be read. Buckets are whole minutes, so the x_min + 1 buckets from
+        current_minute - x_min on are summed: the window covers all of the
+        last `x_min` minutes plus what is before them in the oldest minute.
+        """
+        if (x_min > self.window_minutes) or (self.collection is None):
+            return None
+
+        current_minute = int(time.time() // 60)
+        first_minute = current_minute - x_min
+        counts = np.zeros(3, dtype = np.int64)
+        try:
+            buckets = self.collection.find(
+                                        {"exp_username": username, "minute": {"$gte": datetime.fromtimestamp(first_minute * 60, timezone.utc)}},
+                                        {"_id": 0, "n_total": 1, "n_detected": 1, "n_forward": 1}
+                                        )
+            for bucket in buckets:
+                counts += (bucket["n_total"], bucket["n_detected"], bucket["n_forward"])
+        except Exception as e:
+            print(f"Loading proctoring counters for {username} failed : {e}")
+            return None
+
+        # deltas persist() is writing at this instant are in neither place, a dashboard can live with that
+        with self._lock:
+            for (pending_username, minute), delta in self._pending.items():
+                if (pending_username == username) and (first_minute <= minute <= current_minute):
+                    counts += delta
+        return tuple(int(n) for n in counts)
+
+    def persist(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if (not pending) or (self.collection is None):
+            return
+
+        operations = [
+                    pymongo.UpdateOne(
+                                    {"exp_username": username, "minute": datetime.fromtimestamp(minute * 60, timezone.utc)},
+                                    {"$inc": {"n_total": int(delta[0]), "n_detected": int(delta[1]), "n_forward": int(delta[2])}},
+                                    upsert = True
+                                    )
+                    for (username, minute), delta in pending.items()
+                    ]
+        try:
+            self.collection.bulk_write(operations, ordered = False)
+        except Exception as e:
+            print(f"Persisting {len(operations)} proctoring counter buckets failed : {e}")
+            # put the deltas back so the next round retries them
+            with self._lock:
+                for key, delta in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + delta
+
+    def _run(self):
+        while not self._stop.wait(self.persist_interval):
+            self.persist()
+
+    def close(self, timeout = 10.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout = timeout)
+        self.persist()
@@ -0,0 +1,90 @@
+import time
+import threading
+import numpy as np
+import cv2 as cv
+
+def dct_hash(image, hash_size = 8, resize = 32):
+    """64-bit perceptual hash: signs of the low-frequency DCT coefficients of a 32x32 grayscale thumbnail against their median."""
+    gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    thumbnail = cv.resize(gray, (resize, resize), interpolation = cv.INTER_AREA).astype(np.float32)
+    low = cv.dct(thumbnail)[:hash_size, :hash_size].flatten()
+    # the DC term only tracks overall brightness
+    bits = low[1:] > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def hamming_distance(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count("1")
+
+class FrameHashCache:
+    """
+    Last processed frame per user, by perceptual hash. A new frame within
+    `threshold` bits of it is taken to show the same scene and gets the
+    cached faces back instead of a pose and embedding pass. A cached result
+    is given out for at most `max_age` seconds and `max_reuses` frames before
+    the models run again, so a slow change cannot drift by unnoticed.
+    """
+
+    def __init__(
+                self,
+                threshold = 4,
+                max_age = 5.0,
+                max_reuses = 10,
+                session_ttl = 600.0
+                ):
+        self.threshold = threshold
+        self.max_age = max_age
+        self.max_reuses = max_reuses
+        self.session_ttl = session_ttl
+
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def _expire(self, now):
+        expired = [username for username, entry in self._entries.items() if now - entry["last_seen"] > self.session_ttl]
+        for username in expired:
+            del self._entries[username]
+
+    def lookup(
+            self,
+            username,
+            frame_hash
+            ):
+        """Cached faces for a near-duplicate of the user's last processed frame, otherwise None."""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(username)
+            fresh = (entry is not None) and (now - entry["computed_at"] < self.max_age) and (entry["reuses"] < self.max_reuses)
+            if fresh and (hamming_distance(entry["hash"], frame_hash) <= self.threshold):
+                entry["reuses"] += 1
+                entry["last_seen"] = now
+                self.n_hits += 1
+                return entry["faces"]
+            self.n_misses += 1
+            return None
+
+    def store(
+            self,
+            username,
+            frame_hash,
+            faces
+            ):
+        # only what build_proctoring_events needs, not the crops and embeddings
+        faces = [
+                {key: face.get(key) for key in ("facial_area", "head_pose", "det_username", "match_confidence")}
+                for face in faces
+                ]
+        now = time.time()
+        with self._lock:
+            self._entries[username] = {"hash": frame_hash, "faces": faces, "computed_at": now, "last_seen": now, "reuses": 0}
+
+    def reset(self, username):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def hit_rate(self):
+        with self._lock:
+            n = self.n_hits + self.n_misses
+            return self.n_hits / n if n else 0.0
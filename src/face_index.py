@@ -0,0 +1,998 @@
+import os
+import glob
+import time
+import fcntl
+import shutil
+import threading
+import functools
+import contextlib
+import multiprocessing
+import numpy as np
+import faiss
+from concurrent.futures import ProcessPoolExecutor
+from deepface import DeepFace
+
+FACE_MODEL_NAME = "Facenet512"
+
+# DeepFace detectors, see src/face_detector_benchmark.py for how they compare on our frames
+FACE_DETECTOR_BACKENDS = ["opencv", "ssd", "mtcnn", "retinaface", "mediapipe", "yunet"]
+# only for extract_face_information_for_db, the app enrolls through the proctoring crop (extract_enrollment_face)
+FACE_ENROLLMENT_DETECTOR = os.environ.get("FACE_ENROLLMENT_DETECTOR", "opencv")
+if FACE_ENROLLMENT_DETECTOR not in FACE_DETECTOR_BACKENDS:
+    raise ValueError(f"FACE_ENROLLMENT_DETECTOR must be one of {FACE_DETECTOR_BACKENDS}, not {FACE_ENROLLMENT_DETECTOR}")
+
+# Flat, IVF-Flat, HNSW or IVF-PQ, see src/face_index_benchmark.py for the trade-offs
+FACE_INDEX_TYPE = os.environ.get("FACE_INDEX_TYPE", "Flat")
+FACE_INDEX_NPROBE = int(os.environ.get("FACE_INDEX_NPROBE", 16))
+FACE_INDEX_EF_SEARCH = int(os.environ.get("FACE_INDEX_EF_SEARCH", 64))
+FACE_INDEX_HNSW_M = 32
+FACE_INDEX_PQ_M = 64
+
+# FACE_INDEX_MMAP=1 publishes every save as a snapshot directory next to the
+# index and has readers map it read-only, so worker processes share one copy
+FACE_INDEX_MMAP = os.environ.get("FACE_INDEX_MMAP", "0") == "1"
+FACE_INDEX_SNAPSHOTS_KEPT = 3
+
+# vote (top-5 over every enrolled face) or templates (per-user centroids first)
+FACE_MATCH_STAGE = os.environ.get("FACE_MATCH_STAGE", "vote")
+FACE_TEMPLATES_PER_USER = int(os.environ.get("FACE_TEMPLATES_PER_USER", 1))
+FACE_DETAIL_KEYS = ['ids', 'user_names', 'facial_areas', 'face_confidences', 'embeddings']
+
+# serializes writers of the on-disk index within this process, face_index_write_lock adds the other processes
+enrollment_lock = threading.Lock()
+
+@contextlib.contextmanager
+def file_lock(lock_path):
+    # flock locks belong to the open file, so they also exclude other threads that open it themselves
+    os.makedirs(os.path.dirname(os.path.abspath(lock_path)), exist_ok = True)
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+@contextlib.contextmanager
+def face_index_write_lock(face_index_path = 'models/face_index'):
+    """
+    Exclusive hold on the index files for a load, modify and save cycle:
+    enrollment_lock for the threads of this process, an flock on
+    <face_index_path>.lock for app workers and the CLI in other processes.
+    """
+    with enrollment_lock:
+        with file_lock(f"{face_index_path}.lock"):
+            yield
+
+class FaceIndexSnapshot:
+    """An immutable, fully loaded view of the face index and its details file."""
+
+    def __init__(
+                self,
+                index,
+                user_names,
+                facial_areas,
+                face_confidences,
+                embeddings = None,
+                ids = None,
+                signature = None,
+                templates_per_user = FACE_TEMPLATES_PER_USER
+                ):
+        self.index = index
+        self.user_names = np.asarray(user_names)
+        self.facial_areas = np.asarray(facial_areas)
+        self.face_confidences = np.asarray(face_confidences)
+        self.signature = signature
+        self.loaded_at = time.time()
+
+        # face ids are what the index returns, rows are positions in the details arrays
+        if ids is None:
+            ids = np.arange(len(self.user_names), dtype = np.int64)
+        self.ids = np.asarray(ids, dtype = np.int64)
+        if len(self.ids) != index.ntotal:
+            raise ValueError(f"Face details hold {len(self.ids)} faces but the index holds {index.ntotal}")
+        self._id_order = np.argsort(self.ids, kind = 'stable')
+        self._sorted_ids = self.ids[self._id_order]
+
+        if embeddings is None:
+            embeddings = self._reconstruct_embeddings()
+        self.embeddings = embeddings
+        self.user_embeddings = self._build_user_table()
+        # integer identity per row, so votes over search hits can be counted in NumPy
+        self.identities, self.identity_codes = np.unique(self.user_names, return_inverse = True)
+
+        # built on first use, only the templates match stage needs them
+        self.templates_per_user = templates_per_user
+        self._templates = None
+        self._templates_lock = threading.Lock()
+
+    def rows_for_ids(self, face_ids):
+        """Map face ids returned by the index to rows, -1 for ids that are unknown."""
+        face_ids = np.asarray(face_ids, dtype = np.int64)
+        positions = np.searchsorted(self._sorted_ids, face_ids)
+        positions = np.clip(positions, 0, max(len(self._sorted_ids) - 1, 0))
+        if len(self._sorted_ids) == 0:
+            return np.full(face_ids.shape, -1, dtype = np.int64)
+        found = self._sorted_ids[positions] == face_ids
+        return np.where(found, self._id_order[positions], -1)
+
+    def _reconstruct_embeddings(self):
+        # details files written before embeddings were stored alongside the index
+        try:
+            return self.index.reconstruct_n(0, self.index.ntotal)
+        except RuntimeError:
+            print("Face index does not support reconstruction, 1:1 verification disabled")
+            return None
+
+    def _build_user_table(self):
+        if self.embeddings is None or len(self.user_names) == 0:
+            return {}
+
+        embeddings = np.ascontiguousarray(self.embeddings, dtype = np.float32)
+        # details files and mmap snapshots are stored grouped by user, so every user's block stays a view
+        if bool(np.all(self.user_names[1:] >= self.user_names[:-1])):
+            names, starts = np.unique(self.user_names, return_index = True)
+            ends = np.append(starts[1:], len(self.user_names))
+            return {
+                    str(name): embeddings[start:end]
+                    for name, start, end in zip(names, starts, ends)
+                    }
+
+        order = np.argsort(self.user_names, kind = 'stable')
+        sorted_names = self.user_names[order]
+        names, starts = np.unique(sorted_names, return_index = True)
+        ends = np.append(starts[1:], len(sorted_names))
+        return {
+                str(name): embeddings[order[start:end]]
+                for name, start, end in zip(names, starts, ends)
+                }
+
+    def verify(
+            self,
+            username,
+            embedding,
+            k = 5
+            ):
+        """
+        Score an L2-normalized probe against `username`'s enrolled embeddings only.
+        Returns the mean of the top-k similarities, or None when the user has no
+        enrolled faces.
+        """
+        scores = self.verify_batch(username, np.asarray(embedding, dtype = np.float32).reshape(1, -1), k = k)
+        if scores is None:
+            return None
+        return float(scores[0])
+
+    def verify_batch(
+                    self,
+                    username,
+                    embeddings,
+                    k = 5
+                    ):
+        """verify for an (n, d) matrix of probes, one score per probe."""
+        user_embeddings = self.user_embeddings.get(username)
+        if user_embeddings is None:
+            return None
+
+        scores = user_embeddings @ np.asarray(embeddings, dtype = np.float32).T
+        if len(scores) > k:
+            scores = np.partition(scores, -k, axis = 0)[-k:]
+        return scores.mean(axis = 0)
+
+    def vote(self, D, I):
+        """
+        Majority identity over each row of top-k search hits, with the mean
+        similarity of the hits that voted for it. Ties go to the identity of the
+        best-ranked hit. Returns (identity codes, scores), code -1 when a row
+        has no valid hit.
+        """
+        rows = self.rows_for_ids(I)
+        valid = rows >= 0
+        codes = np.where(valid, self.identity_codes[np.maximum(rows, 0)], -1)
+
+        votes = ((codes[:, :, None] == codes[:, None, :]) & valid[:, None, :]).sum(axis = 2)
+        votes = np.where(valid, votes, 0)
+        winners = codes[np.arange(len(codes)), votes.argmax(axis = 1)]
+
+        voted = (codes == winners[:, None]) & valid
+        scores = (D * voted).sum(axis = 1) / np.maximum(voted.sum(axis = 1), 1)
+        winners = np.where(valid.any(axis = 1), winners, -1)
+        return winners, scores
+
+    def templates(self):
+        """
+        First-stage index of per-user templates: the normalized mean of each
+        user's embeddings, or `templates_per_user` k-means centroids for users
+        enrolled with more faces than that. Returns (index, identity code per
+        template).
+        """
+        if self._templates is not None:
+            return self._templates
+        with self._templates_lock:
+            if self._templates is not None:
+                return self._templates
+
+            d = self.index.d
+            codes = {str(name): code for code, name in enumerate(self.identities)}
+            templates, owners = [], []
+            for name, user_embeddings in self.user_embeddings.items():
+                if len(user_embeddings) > self.templates_per_user > 1:
+                    # a handful of enrollment images per user, well under the 39 points per centroid FAISS asks for
+                    kmeans = faiss.Kmeans(d, self.templates_per_user, niter = 10, verbose = False, min_points_per_centroid = 1)
+                    kmeans.train(np.ascontiguousarray(user_embeddings))
+                    centroids = kmeans.centroids
+                else:
+                    centroids = user_embeddings.mean(axis = 0, keepdims = True)
+                templates.append(centroids)
+                owners.extend([codes[name]] * len(centroids))
+
+            template_index = faiss.IndexFlatIP(d)
+            if templates:
+                templates = np.ascontiguousarray(np.concatenate(templates), dtype = np.float32)
+                faiss.normalize_L2(templates)
+                template_index.add(templates)
+            self._templates = (template_index, np.asarray(owners, dtype = np.int64))
+            return self._templates
+
+    def match_templates(
+                        self,
+                        embeddings,
+                        threshold = 0.5,
+                        margin = 0.1,
+                        k = 5
+                        ):
+        """
+        Top-1 identity per L2-normalized probe from the user templates. When
+        the best template score is within `margin` of `threshold` or of the
+        runner-up user, the probe is re-scored against the raw embeddings of
+        both users, as verify does. Returns (identity codes, scores,
+        re-checked mask); code -1 when no user is enrolled.
+        """
+        embeddings = np.asarray(embeddings, dtype = np.float32)
+        template_index, owners = self.templates()
+        n = len(embeddings)
+        if template_index.ntotal == 0:
+            return np.full(n, -1, dtype = np.int64), np.zeros(n, dtype = np.float32), np.zeros(n, dtype = bool)
+
+        # enough hits to see a second user even when the best one owns several templates
+        D, I = template_index.search(embeddings, min(template_index.ntotal, 2 * max(self.templates_per_user, 1)))
+        codes = owners[I]
+        best_codes, best_scores = codes[:, 0], D[:, 0].copy()
+
+        other = codes != best_codes[:, None]
+        has_second = other.any(axis = 1)
+        second_col = other.argmax(axis = 1)
+        second_codes = np.where(has_second, codes[np.arange(n), second_col], -1)
+        second_scores = np.where(has_second, D[np.arange(n), second_col], -np.inf)
+
+        rechecked = (np.abs(best_scores - threshold) < margin) | (best_scores - second_scores < margin)
+        for i in np.flatnonzero(rechecked):
+            candidates = [code for code in (best_codes[i], second_codes[i]) if code >= 0]
+            scores = [self.verify_batch(str(self.identities[code]), embeddings[i:i + 1], k = k)[0] for code in candidates]
+            best = int(np.argmax(scores))
+            best_codes[i], best_scores[i] = candidates[best], scores[best]
+        return best_codes, best_scores, rechecked
+
+class FaceIndexManager:
+    """
+    Process-resident owner of the face index.
+
+    The index and details file are loaded once and every search reads the
+    in-memory snapshot. At most every `check_interval` seconds the files are
+    stat'ed; when their size or mtime changed a new snapshot is loaded off to
+    the side and swapped in with a single reference assignment, so readers
+    never see a half-loaded index.
+    """
+
+    def __init__(
+                self,
+                face_index_path,
+                face_details_path,
+                loader,
+                check_interval = 2.0,
+                watch_paths = None
+                ):
+        self.face_index_path = face_index_path
+        self.face_details_path = face_details_path
+        self.loader = loader
+        self.check_interval = check_interval
+        # the files whose size and mtime decide when to reload
+        self.watch_paths = watch_paths or (face_index_path, face_details_path)
+
+        self._snapshot = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def _file_signature(self):
+        signature = []
+        for path in self.watch_paths:
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def _load(self):
+        signature = self._file_signature()
+        index, details = self.loader()
+        # the loader may have built the files, so take the signature of what is now on disk
+        if None in signature:
+            signature = self._file_signature()
+        return FaceIndexSnapshot(
+                                index,
+                                details['user_names'],
+                                details['facial_areas'],
+                                details['face_confidences'],
+                                embeddings = details.get('embeddings'),
+                                ids = details.get('ids'),
+                                signature = signature
+                                )
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = self._load()
+                    self._last_check = time.time()
+                return self._snapshot
+
+        now = time.time()
+        if now - self._last_check >= self.check_interval and self._lock.acquire(blocking = False):
+            try:
+                self._last_check = now
+                if self._file_signature() != snapshot.signature:
+                    self._reload()
+            finally:
+                self._lock.release()
+        return self._snapshot
+
+    def reload(self):
+        with self._lock:
+            self._last_check = time.time()
+            return self._reload()
+
+    def _reload(self):
+        try:
+            snapshot = self._load()
+        except Exception as e:
+            # keep serving the previous snapshot, the files may be mid-write
+            print(f"Face index reload failed, keeping previous snapshot : {e}")
+            return self._snapshot
+
+        self._snapshot = snapshot
+        print(f"Face index reloaded with {snapshot.index.ntotal} faces")
+        return snapshot
+
+    def set_snapshot(self, snapshot):
+        self._snapshot = snapshot
+        self._last_check = time.time()
+
+def extract_face_information_for_db(
+                                    img_path,
+                                    detector_backend = None
+                                    ):
+    face_objs = DeepFace.represent(
+                                img_path = img_path,
+                                model_name = FACE_MODEL_NAME,
+                                detector_backend = detector_backend or FACE_ENROLLMENT_DETECTOR,
+                                enforce_detection = False
+                                )
+    img_path = img_path.replace("\\", "/")
+    user_name = img_path.split("/")[-2]
+
+    if len(face_objs) != 1:
+        if len(face_objs) == 0:
+            Warning(f"No faces detected in the image : {img_path}")
+        else:
+            Warning(f"Multiple faces detected in the image : {img_path}")
+        return None, None, None, None
+
+    else:
+        facial_area = face_objs[0]['facial_area']
+        embeddings = face_objs[0]['embedding']
+        face_confidence = face_objs[0]['face_confidence']
+        x, y, w, h = facial_area['x'], facial_area['y'], facial_area['w'], facial_area['h']
+
+    return embeddings, face_confidence, (x, y, w, h), user_name
+
+def face_index_factory_string(
+                            index_type,
+                            n_train,
+                            d = 512
+                            ):
+    """
+    FAISS factory string for `index_type` sized for `n_train` training vectors,
+    or None when there are too few vectors to train it.
+    """
+    if index_type == "Flat":
+        return "Flat"
+    if index_type == "HNSW":
+        return f"HNSW{FACE_INDEX_HNSW_M}"
+
+    # ~4 sqrt(n) lists, with the 39 points per centroid k-means wants
+    nlist = min(int(4 * np.sqrt(max(n_train, 1))), n_train // 39)
+    if index_type == "IVF-Flat":
+        if nlist < 1:
+            return None
+        return f"IVF{nlist},Flat"
+    if index_type == "IVF-PQ":
+        # 8-bit PQ codebooks are 256 centroids, again with 39 points each
+        if (nlist < 1) or (n_train < 39 * 256) or (d % FACE_INDEX_PQ_M != 0):
+            return None
+        return f"IVF{nlist},PQ{FACE_INDEX_PQ_M}"
+
+    raise ValueError(f"Unknown face index type : {index_type}")
+
+def configure_face_index(faiss_index):
+    # search-time knobs are not reliably carried through write_index, set them after every load
+    parameter_space = faiss.ParameterSpace()
+    base_index = faiss.downcast_index(faiss_index.index) if isinstance(faiss_index, faiss.IndexIDMap) else faiss_index
+    if hasattr(base_index, 'nprobe'):
+        parameter_space.set_index_parameter(faiss_index, 'nprobe', FACE_INDEX_NPROBE)
+    if hasattr(base_index, 'hnsw'):
+        parameter_space.set_index_parameter(faiss_index, 'efSearch', FACE_INDEX_EF_SEARCH)
+    return faiss_index
+
+def new_face_index(
+                d = 512,
+                index_type = None,
+                train_embeddings = None
+                ):
+    """
+    Empty ID-mapped inner-product index of `index_type` (FACE_INDEX_TYPE by
+    default). IVF indexes are trained on `train_embeddings`; when there are not
+    enough of them to train, a Flat index is returned instead.
+    """
+    index_type = index_type or FACE_INDEX_TYPE
+    n_train = 0 if train_embeddings is None else len(train_embeddings)
+    factory_string = face_index_factory_string(index_type, n_train, d = d)
+    if factory_string is None:
+        print(f"Only {n_train} faces, too few to train a {index_type} face index, using Flat")
+        factory_string = "Flat"
+
+    base_index = faiss.index_factory(d, factory_string, faiss.METRIC_INNER_PRODUCT)
+    if not base_index.is_trained:
+        base_index.train(np.ascontiguousarray(train_embeddings, dtype = np.float32))
+    return configure_face_index(faiss.IndexIDMap2(base_index))
+
+def rebuild_face_index(
+                    details,
+                    d = 512,
+                    index_type = None
+                    ):
+    """Re-create the index from the stored embeddings, no re-embedding needed."""
+    embeddings = np.ascontiguousarray(details['embeddings'], dtype = np.float32).reshape(-1, d)
+    faiss_index = new_face_index(d, index_type = index_type, train_embeddings = embeddings)
+    faiss_index.add_with_ids(embeddings, np.ascontiguousarray(details['ids'], dtype = np.int64))
+    return faiss_index
+
+def fsync_dir(path):
+    try:
+        dir_fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+def fsync_replace(tmp_path, path):
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+def face_index_snapshot_dir(face_index_path = 'models/face_index'):
+    return f"{face_index_path}_snapshots"
+
+def flat_vectors(faiss_index):
+    """The vectors of a Flat index as a read-only view of its own storage, None for other index types."""
+    base_index = faiss.downcast_index(faiss_index.index) if isinstance(faiss_index, faiss.IndexIDMap) else faiss_index
+    if (not isinstance(base_index, faiss.IndexFlat)) or (base_index.ntotal == 0):
+        return None
+    vectors = faiss.rev_swig_ptr(base_index.get_xb(), base_index.ntotal * base_index.d).reshape(base_index.ntotal, base_index.d)
+    vectors.setflags(write = False)
+    return vectors
+
+def publish_face_index_snapshot(
+                                faiss_index,
+                                face_details,
+                                snapshot_dir = 'models/face_index_snapshots',
+                                keep = FACE_INDEX_SNAPSHOTS_KEPT
+                                ):
+    """
+    Write the index and details as a new versioned directory under
+    `snapshot_dir` and point CURRENT at it. The details are fixed-width .npy
+    arrays with rows grouped by user, so readers can map them as they are.
+    A Flat index is written in that same row order and no embeddings.npy
+    is kept next to it: readers take the embeddings from the mapped index,
+    so the vectors are on disk and in the page cache once. The directory
+    is complete and fsync'ed before it is renamed into place, and CURRENT
+    is swapped by rename. A reader sees either the old snapshot or the new
+    one. Only the newest `keep` snapshots are kept. Processes still mapping
+    an older one keep their pages until they reload.
+    """
+    os.makedirs(snapshot_dir, exist_ok = True)
+    version = f"{time.time_ns():020d}"
+    tmp_dir = os.path.join(snapshot_dir, f".{version}.tmp")
+    os.makedirs(tmp_dir)
+
+    order = np.argsort(np.asarray(face_details['user_names']), kind = 'stable')
+    detail_keys = FACE_DETAIL_KEYS
+    if flat_vectors(faiss_index) is not None:
+        base_index = faiss.downcast_index(faiss_index.index) if isinstance(faiss_index, faiss.IndexIDMap) else faiss_index
+        faiss_index = faiss.IndexIDMap2(faiss.IndexFlat(base_index.d, base_index.metric_type))
+        faiss_index.add_with_ids(
+                                np.ascontiguousarray(np.asarray(face_details['embeddings'], dtype = np.float32)[order]),
+                                np.ascontiguousarray(np.asarray(face_details['ids'], dtype = np.int64)[order])
+                                )
+        detail_keys = [key for key in FACE_DETAIL_KEYS if key != 'embeddings']
+
+    index_path = os.path.join(tmp_dir, 'index.faiss')
+    faiss.write_index(faiss_index, index_path)
+    paths = [index_path]
+
+    for key in detail_keys:
+        path = os.path.join(tmp_dir, f"{key}.npy")
+        np.save(path, np.ascontiguousarray(np.asarray(face_details[key])[order]))
+        paths.append(path)
+    for path in paths:
+        with open(path, 'rb') as f:
+            os.fsync(f.fileno())
+    fsync_dir(tmp_dir)
+
+    os.rename(tmp_dir, os.path.join(snapshot_dir, version))
+    fsync_dir(snapshot_dir)
+
+    current_path = os.path.join(snapshot_dir, 'CURRENT')
+    with open(f"{current_path}.tmp", 'w') as f:
+        f.write(version)
+    fsync_replace(f"{current_path}.tmp", current_path)
+
+    versions = sorted(name for name in os.listdir(snapshot_dir) if name.isdigit())
+    for old_version in versions[:-keep]:
+        shutil.rmtree(os.path.join(snapshot_dir, old_version), ignore_errors = True)
+    return version
+
+def load_face_index_snapshot(snapshot_dir = 'models/face_index_snapshots'):
+    """
+    The snapshot CURRENT points at, with the index and the details arrays
+    mapped read-only. IO_FLAG_MMAP_IFC maps the vectors of every index
+    type, Flat and HNSW included, where IO_FLAG_MMAP still reads those
+    into private memory. Index files FAISS cannot map are read into memory.
+    """
+    with open(os.path.join(snapshot_dir, 'CURRENT')) as f:
+        version_dir = os.path.join(snapshot_dir, f.read().strip())
+
+    index_path = os.path.join(version_dir, 'index.faiss')
+    faiss_index = None
+    for io_flags in (faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY):
+        try:
+            faiss_index = faiss.read_index(index_path, io_flags)
+            break
+        except RuntimeError as e:
+            print(f"Face index cannot be memory-mapped with flags {io_flags} : {e}")
+    if faiss_index is None:
+        faiss_index = faiss.read_index(index_path)
+
+    details = {
+                key: np.load(os.path.join(version_dir, f"{key}.npy"), mmap_mode = 'r')
+                for key in FACE_DETAIL_KEYS
+                if os.path.exists(os.path.join(version_dir, f"{key}.npy"))
+                }
+    if 'embeddings' not in details:
+        # Flat snapshots store the vectors in the index only, in details row order
+        details['embeddings'] = flat_vectors(faiss_index)
+    return configure_face_index(faiss_index), details
+
+def group_face_details_by_user(face_details):
+    # rows of one user next to each other, so FaceIndexSnapshot can slice user blocks as views
+    user_names = np.asarray(face_details['user_names'])
+    if bool(np.all(user_names[1:] >= user_names[:-1])):
+        return face_details
+    order = np.argsort(user_names, kind = 'stable')
+    return {key: np.asarray(value)[order] for key, value in face_details.items()}
+
+def save_face_index(
+                    faiss_index,
+                    face_details,
+                    face_index_path = 'models/face_index',
+                    face_details_path = 'models/face_details.npz',
+                    ):
+    """
+    Durably replace the index and details files. Each file is written to a
+    temporary name, fsync'ed and renamed over the old one, so a crash leaves
+    either the old or the new file, never a torn one. The pair as a whole is
+    not swapped atomically: the details file, which holds the ids and the
+    embeddings, is the source of truth and goes first. load_face_index_pair
+    rebuilds the index from it whenever the index on disk holds other ids.
+    With FACE_INDEX_MMAP the pair is also published as a mapped snapshot.
+    The details rows are stored grouped by user; rows are tied to the
+    index by their ids, not their position, so the index is not touched.
+    """
+    face_details = group_face_details_by_user(face_details)
+    os.makedirs(os.path.dirname(os.path.abspath(face_index_path)), exist_ok = True)
+    os.makedirs(os.path.dirname(os.path.abspath(face_details_path)), exist_ok = True)
+
+    # np.savez appends .npz to names that lack it
+    tmp_details_path = f"{face_details_path}.tmp.npz"
+    np.savez(tmp_details_path, **face_details)
+    fsync_replace(tmp_details_path, face_details_path)
+
+    tmp_index_path = f"{face_index_path}.tmp"
+    faiss.write_index(faiss_index, tmp_index_path)
+    fsync_replace(tmp_index_path, face_index_path)
+
+    if FACE_INDEX_MMAP:
+        publish_face_index_snapshot(faiss_index, face_details, face_index_snapshot_dir(face_index_path))
+
+def load_face_details(
+                    faiss_index,
+                    face_details_path = 'models/face_details.npz'
+                    ):
+    face_details = np.load(face_details_path)
+    details = {key: face_details[key] for key in face_details.files}
+    if 'ids' not in details:
+        details['ids'] = np.arange(len(details['user_names']), dtype = np.int64)
+    if 'embeddings' not in details:
+        details['embeddings'] = faiss_index.reconstruct_n(0, faiss_index.ntotal)
+    return details
+
+def face_index_matches_details(
+                                faiss_index,
+                                details
+                                ):
+    """True when the index holds exactly the face ids of the details file."""
+    if not isinstance(faiss_index, faiss.IndexIDMap):
+        return faiss_index.ntotal == len(details['ids'])
+    index_ids = faiss.vector_to_array(faiss_index.id_map)
+    return np.array_equal(np.sort(index_ids), np.sort(np.asarray(details['ids'], dtype = np.int64)))
+
+def load_face_index_pair(
+                        face_index_path = 'models/face_index',
+                        face_details_path = 'models/face_details.npz',
+                        ):
+    faiss_index = faiss.read_index(face_index_path)
+    details = load_face_details(faiss_index, face_details_path)
+
+    if not face_index_matches_details(faiss_index, details):
+        # a save interrupted between the two renames, the details file wins
+        print(f"{face_index_path} does not match {face_details_path}, rebuilding the index from the stored embeddings")
+        faiss_index = rebuild_face_index(details, d = faiss_index.d)
+    elif not isinstance(faiss_index, faiss.IndexIDMap2):
+        # indexes built before enrollment support are positional, re-key them by face id
+        faiss_index = rebuild_face_index(details, d = faiss_index.d)
+
+    return configure_face_index(faiss_index), details
+
+def load_face_index_for_update(
+                                d = 512,
+                                face_index_path = 'models/face_index',
+                                face_details_path = 'models/face_details.npz',
+                                ):
+    if (not os.path.exists(face_index_path)) or (not os.path.exists(face_details_path)):
+        return new_face_index(d), {
+                                    'ids': np.zeros((0,), dtype = np.int64),
+                                    'user_names': np.zeros((0,), dtype = str),
+                                    'facial_areas': np.zeros((0, 4), dtype = np.int64),
+                                    'face_confidences': np.zeros((0,), dtype = np.float64),
+                                    'embeddings': np.zeros((0, d), dtype = np.float32),
+                                    }
+
+    return load_face_index_pair(face_index_path, face_details_path)
+
+def remove_faces_from_index(
+                            faiss_index,
+                            details,
+                            username
+                            ):
+    mask = details['user_names'] == username
+    n_removed = int(mask.sum())
+    if n_removed:
+        details_kept = {key: value[~mask] for key, value in details.items()}
+        try:
+            faiss_index.remove_ids(np.ascontiguousarray(details['ids'][mask], dtype = np.int64))
+        except RuntimeError:
+            # HNSW graphs cannot drop vectors, rebuild from the stored embeddings
+            faiss_index = rebuild_face_index(details_kept, d = faiss_index.d)
+        details = details_kept
+    return faiss_index, details, n_removed
+
+def enroll_user_faces(
+                    username,
+                    img_paths,
+                    replace = False,
+                    manager = None,
+                    d = 512,
+                    face_index_path = 'models/face_index',
+                    face_details_path = 'models/face_details.npz',
+                    face_extractor = None,
+                    ):
+    """
+    Embed `img_paths` and add them to the index under `username` without
+    touching anyone else's entries. With `replace` the user's existing faces
+    are dropped first, but only when a new face was found: an image without
+    one leaves the current enrollment as it is. `face_extractor` defaults
+    to extract_face_information_for_db and has to crop the way the probes
+    are cropped at inference. Returns the number of faces added.
+    """
+    face_extractor = face_extractor or extract_face_information_for_db
+    embeddings = []
+    facial_areas = []
+    face_confidences = []
+    for img_path in img_paths:
+        emb, face_confidence, facial_area, _ = face_extractor(img_path)
+        if emb is not None:
+            embeddings.append(emb)
+            facial_areas.append(facial_area)
+            face_confidences.append(face_confidence)
+
+    if len(embeddings) == 0:
+        return 0
+
+    embeddings = np.asarray(embeddings, dtype = np.float32).reshape(-1, d)
+    faiss.normalize_L2(embeddings)
+
+    with face_index_write_lock(face_index_path):
+        faiss_index, details = load_face_index_for_update(
+                                                        d = d,
+                                                        face_index_path = face_index_path,
+                                                        face_details_path = face_details_path
+                                                        )
+        if replace:
+            faiss_index, details, _ = remove_faces_from_index(faiss_index, details, username)
+
+        next_id = int(details['ids'].max()) + 1 if len(details['ids']) else 0
+        new_ids = np.arange(next_id, next_id + len(embeddings), dtype = np.int64)
+        faiss_index.add_with_ids(embeddings, new_ids)
+
+        details = {
+                'ids': np.concatenate([details['ids'], new_ids]),
+                'user_names': np.concatenate([details['user_names'], np.asarray([username] * len(embeddings), dtype = str)]),
+                'facial_areas': np.concatenate([details['facial_areas'].reshape(-1, 4), np.asarray(facial_areas, dtype = np.int64).reshape(-1, 4)]),
+                'face_confidences': np.concatenate([details['face_confidences'], np.asarray(face_confidences, dtype = np.float64)]),
+                'embeddings': np.concatenate([details['embeddings'], embeddings]),
+                }
+        save_face_index(faiss_index, details, face_index_path, face_details_path)
+
+    if manager is not None:
+        manager.reload()
+    return len(embeddings)
+
+def remove_user_faces(
+                    username,
+                    manager = None,
+                    d = 512,
+                    face_index_path = 'models/face_index',
+                    face_details_path = 'models/face_details.npz',
+                    ):
+    """Drop every face enrolled for `username`. Returns the number of faces removed."""
+    with face_index_write_lock(face_index_path):
+        if (not os.path.exists(face_index_path)) or (not os.path.exists(face_details_path)):
+            return 0
+
+        faiss_index, details = load_face_index_for_update(
+                                                        d = d,
+                                                        face_index_path = face_index_path,
+                                                        face_details_path = face_details_path
+                                                        )
+        faiss_index, details, n_removed = remove_faces_from_index(faiss_index, details, username)
+        if n_removed:
+            save_face_index(faiss_index, details, face_index_path, face_details_path)
+
+    if (manager is not None) and n_removed:
+        manager.reload()
+    return n_removed
+
+def init_embedding_worker():
+    # load the model once per worker instead of on the first image of every chunk
+    DeepFace.build_model(FACE_MODEL_NAME)
+
+def embed_face_image(
+                    img_path,
+                    face_extractor = None
+                    ):
+    try:
+        return (face_extractor or extract_face_information_for_db)(img_path)
+    except Exception as e:
+        print(f"Failed to embed {img_path} : {e}")
+        return None, None, None, None
+
+def load_build_checkpoints(checkpoint_dir):
+    done = {}
+    for checkpoint_path in sorted(glob.glob(os.path.join(checkpoint_dir, 'chunk_*.npz'))):
+        try:
+            checkpoint = np.load(checkpoint_path)
+        except Exception as e:
+            print(f"Ignoring unreadable checkpoint {checkpoint_path} : {e}")
+            continue
+        for i, img_path in enumerate(checkpoint['img_paths']):
+            if checkpoint['found'][i]:
+                done[str(img_path)] = (
+                                    checkpoint['embeddings'][i],
+                                    float(checkpoint['face_confidences'][i]),
+                                    tuple(checkpoint['facial_areas'][i]),
+                                    str(checkpoint['user_names'][i])
+                                    )
+            else:
+                done[str(img_path)] = (None, None, None, None)
+    return done
+
+def save_build_checkpoint(
+                        checkpoint_dir,
+                        chunk_idx,
+                        img_paths,
+                        results,
+                        d = 512
+                        ):
+    found = np.array([emb is not None for emb, _, _, _ in results], dtype = bool)
+    embeddings = np.zeros((len(results), d), dtype = np.float32)
+    facial_areas = np.zeros((len(results), 4), dtype = np.int64)
+    face_confidences = np.zeros((len(results),), dtype = np.float64)
+    user_names = []
+    for i, (emb, face_confidence, facial_area, user_name) in enumerate(results):
+        if emb is not None:
+            embeddings[i] = emb
+            facial_areas[i] = facial_area
+            face_confidences[i] = face_confidence
+        user_names.append(user_name or "")
+
+    checkpoint_path = os.path.join(checkpoint_dir, f"chunk_{chunk_idx:06d}.npz")
+    tmp_checkpoint_path = f"{checkpoint_path}.tmp.npz"
+    np.savez(
+            tmp_checkpoint_path,
+            img_paths = np.asarray(img_paths, dtype = str),
+            found = found,
+            embeddings = embeddings,
+            facial_areas = facial_areas,
+            face_confidences = face_confidences,
+            user_names = np.asarray(user_names, dtype = str)
+            )
+    fsync_replace(tmp_checkpoint_path, checkpoint_path)
+
+def build_face_index_bulk(
+                        d = 512,
+                        face_index_path = 'models/face_index',
+                        face_image_dir = 'data/facedb/*/*.jpg',
+                        face_details_path = 'models/face_details.npz',
+                        checkpoint_dir = 'models/face_index_checkpoint',
+                        workers = None,
+                        chunk_size = 256,
+                        index_type = None,
+                        only_if_missing = False,
+                        face_extractor = None,
+                        worker_initializer = None
+                        ):
+    """
+    Embed every image under `face_image_dir` across a process pool and write
+    the index and details files. Results are checkpointed every `chunk_size`
+    images, so a crashed build picks up where it stopped when run again. The
+    checkpoints are deleted once the final files are in place. The workers
+    embed with `face_extractor` (extract_face_information_for_db by default)
+    after running `worker_initializer`, both must be module-level functions.
+
+    The whole build holds an flock on <face_index_path>.build.lock, so
+    processes that all find the index missing at start-up do not run
+    builds over the same checkpoint directory. With `only_if_missing`
+    the files are checked again once the lock is held, and an index
+    another process built in the meantime is loaded instead.
+    """
+    with file_lock(f"{face_index_path}.build.lock"):
+        if only_if_missing and os.path.exists(face_index_path) and os.path.exists(face_details_path):
+            print(f"{face_index_path} was built by another process, loading it")
+            return load_face_index_pair(face_index_path, face_details_path)
+        return run_face_index_build(d, face_index_path, face_image_dir, face_details_path, checkpoint_dir, workers, chunk_size, index_type, face_extractor, worker_initializer)
+
+def run_face_index_build(
+                        d,
+                        face_index_path,
+                        face_image_dir,
+                        face_details_path,
+                        checkpoint_dir,
+                        workers,
+                        chunk_size,
+                        index_type,
+                        face_extractor = None,
+                        worker_initializer = None
+                        ):
+    # build_face_index_bulk without the build lock, callers hold it
+    img_paths = sorted(glob.glob(face_image_dir))
+    n_images = len(img_paths)
+    os.makedirs(checkpoint_dir, exist_ok = True)
+
+    done = load_build_checkpoints(checkpoint_dir)
+    pending = [img_path for img_path in img_paths if img_path not in done]
+    if done:
+        print(f"Resuming face index build, {n_images - len(pending)}/{n_images} images already embedded")
+
+    if pending:
+        workers = workers or os.cpu_count() or 1
+        chunk_idx = len(glob.glob(os.path.join(checkpoint_dir, 'chunk_*.npz')))
+        # spawn, TensorFlow does not survive being forked after it has initialized
+        with ProcessPoolExecutor(
+                                max_workers = workers,
+                                initializer = worker_initializer or init_embedding_worker,
+                                mp_context = multiprocessing.get_context('spawn')
+                                ) as pool:
+            for start in range(0, len(pending), chunk_size):
+                chunk = pending[start:start + chunk_size]
+                results = list(pool.map(functools.partial(embed_face_image, face_extractor = face_extractor), chunk, chunksize = max(1, len(chunk) // (workers * 4))))
+                save_build_checkpoint(checkpoint_dir, chunk_idx, chunk, results, d = d)
+                chunk_idx += 1
+                done.update(zip(chunk, results))
+                print(f"Processed {n_images - len(pending) + start + len(chunk)}/{n_images} images")
+
+    results = [done[img_path] for img_path in img_paths if done[img_path][0] is not None]
+    embeddings = np.asarray([emb for emb, _, _, _ in results], dtype = np.float32).reshape(-1, d)
+    faiss.normalize_L2(embeddings)
+    ids = np.arange(len(embeddings), dtype = np.int64)
+
+    faiss_index = new_face_index(d, index_type = index_type, train_embeddings = embeddings)
+    faiss_index.add_with_ids(embeddings, ids)
+    face_details = {
+                    'ids': ids,
+                    'user_names': np.asarray([user_name for _, _, _, user_name in results], dtype = str),
+                    'facial_areas': np.asarray([facial_area for _, _, facial_area, _ in results], dtype = np.int64).reshape(-1, 4),
+                    'face_confidences': np.asarray([face_confidence for _, face_confidence, _, _ in results], dtype = np.float64),
+                    'embeddings': embeddings
+                    }
+    face_details = group_face_details_by_user(face_details)
+    with face_index_write_lock(face_index_path):
+        save_face_index(faiss_index, face_details, face_index_path, face_details_path)
+    shutil.rmtree(checkpoint_dir, ignore_errors = True)
+
+    return faiss_index, face_details
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description = "Cold build of the face index from a folder of enrollment images")
+    parser.add_argument('--face_image_dir', default = 'data/facedb/*/*.jpg')
+    parser.add_argument('--face_index_path', default = 'models/face_index')
+    parser.add_argument('--face_details_path', default = 'models/face_details.npz')
+    parser.add_argument('--checkpoint_dir', default = 'models/face_index_checkpoint')
+    parser.add_argument('--workers', type = int, default = None)
+    parser.add_argument('--chunk_size', type = int, default = 256)
+    parser.add_argument('--index_type', default = None, choices = ["Flat", "IVF-Flat", "HNSW", "IVF-PQ"])
+    parser.add_argument('--rebuild', action = 'store_true', help = "re-create the index from the stored embeddings, e.g. to change its type")
+    parser.add_argument('--publish_snapshot', action = 'store_true', help = "publish the current index as a memory-mappable snapshot")
+    args = parser.parse_args()
+
+    if args.publish_snapshot:
+        with face_index_write_lock(args.face_index_path):
+            faiss_index, details = load_face_index_for_update(
+                                                            face_index_path = args.face_index_path,
+                                                            face_details_path = args.face_details_path
+                                                            )
+            version = publish_face_index_snapshot(faiss_index, details, face_index_snapshot_dir(args.face_index_path))
+        print(f"Published face index snapshot {version} with {faiss_index.ntotal} faces")
+        raise SystemExit(0)
+
+    if args.rebuild:
+        with face_index_write_lock(args.face_index_path):
+            faiss_index, details = load_face_index_for_update(
+                                                            face_index_path = args.face_index_path,
+                                                            face_details_path = args.face_details_path
+                                                            )
+            faiss_index = rebuild_face_index(details, index_type = args.index_type)
+            save_face_index(faiss_index, details, args.face_index_path, args.face_details_path)
+        print(f"Face index rebuilt with {faiss_index.ntotal} faces")
+        raise SystemExit(0)
+
+    # embed through the proctoring crop, the index has to match what inference probes with
+    from src.face_monitoring_inference import extract_enrollment_face, init_enrollment_worker
+    faiss_index, _ = build_face_index_bulk(
+                                        face_index_path = args.face_index_path,
+                                        face_image_dir = args.face_image_dir,
+                                        face_details_path = args.face_details_path,
+                                        checkpoint_dir = args.checkpoint_dir,
+                                        workers = args.workers,
+                                        chunk_size = args.chunk_size,
+                                        index_type = args.index_type,
+                                        face_extractor = extract_enrollment_face,
+                                        worker_initializer = init_enrollment_worker
+                                        )
+    print(f"Face index built with {faiss_index.ntotal} faces")
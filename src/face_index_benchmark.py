@@ -0,0 +1,274 @@
+import time
+import argparse
+import numpy as np
+import faiss
+from src.face_index import new_face_index, FACE_INDEX_NPROBE, FACE_INDEX_EF_SEARCH
+
+INDEX_TYPES = ["Flat", "IVF-Flat", "HNSW", "IVF-PQ"]
+
+def facenet512_like_centers(
+                            n_users,
+                            d = 512,
+                            users_per_family = 4,
+                            shared = 0.14,
+                            family = 0.43,
+                            rng = None
+                            ):
+    """
+    One unit center per user, made of a direction every face shares
+    (`shared` of the energy), one shared by a small family of look-alike
+    users (`family`) and the user's own. Real Facenet512 embeddings are not
+    isotropic: unrelated faces still have a positive cosine and some
+    students look alike, which is what makes approximate search miss.
+    """
+    rng = rng if rng is not None else np.random.default_rng(0)
+    n_families = max(1, -(-n_users // users_per_family))
+    common = rng.standard_normal((1, d), dtype = np.float32)
+    families = rng.standard_normal((n_families, d), dtype = np.float32)
+    own = rng.standard_normal((n_users, d), dtype = np.float32)
+    faiss.normalize_L2(common)
+    faiss.normalize_L2(families)
+    faiss.normalize_L2(own)
+
+    user_family = rng.permutation(np.arange(n_users) % n_families)
+    centers = np.sqrt(shared) * common + np.sqrt(family) * families[user_family] + np.sqrt(1 - shared - family) * own
+    centers = centers.astype(np.float32)
+    faiss.normalize_L2(centers)
+    return centers
+
+def noisy_samples(
+                centers,
+                user_ids,
+                noise,
+                rng,
+                noise_spread = 0.5
+                ):
+    # the noise scale varies per face, poor lighting or pose gives some far-off samples
+    d = centers.shape[1]
+    scale = noise * rng.lognormal(0.0, noise_spread, len(user_ids)).astype(np.float32)
+    samples = centers[user_ids] + (scale[:, None] / np.sqrt(d)) * rng.standard_normal((len(user_ids), d), dtype = np.float32)
+    samples = samples.astype(np.float32)
+    faiss.normalize_L2(samples)
+    return samples
+
+def synthetic_face_embeddings(
+                            n_faces,
+                            d = 512,
+                            faces_per_user = 5,
+                            noise = 0.65,
+                            seed = 0,
+                            chunk_size = 100000
+                            ):
+    """
+    L2-normalized embeddings clustered by identity, `faces_per_user` noisy
+    samples around each user's center. With the defaults two faces of the
+    same user have a cosine around 0.65 with a tail down to 0.3, unrelated
+    users around 0.1 and each face's nearest other user around 0.45, close
+    to what Facenet512 gives on enrollment photos. similarity_profile()
+    prints the actual figures.
+    """
+    rng = np.random.default_rng(seed)
+    n_users = max(1, n_faces // faces_per_user)
+    centers = facenet512_like_centers(n_users, d = d, rng = rng)
+
+    user_ids = np.arange(n_faces) % n_users
+    embeddings = np.empty((n_faces, d), dtype = np.float32)
+    for start in range(0, n_faces, chunk_size):
+        end = min(start + chunk_size, n_faces)
+        embeddings[start:end] = noisy_samples(centers, user_ids[start:end], noise, rng)
+    return embeddings, user_ids, centers
+
+def synthetic_probes(
+                    centers,
+                    n_queries,
+                    noise = 0.65,
+                    seed = 1
+                    ):
+    rng = np.random.default_rng(seed)
+    user_ids = rng.integers(0, len(centers), n_queries)
+    return noisy_samples(centers, user_ids, noise, rng), user_ids
+
+def load_face_embeddings(
+                        embeddings_path,
+                        n_queries,
+                        seed = 1
+                        ):
+    """
+    Real embeddings from an (n, d) .npy file, e.g. the `embeddings` of a
+    face_details.npz. `n_queries` random rows are held out as probes and
+    the rest is indexed.
+    """
+    embeddings = np.ascontiguousarray(np.load(embeddings_path), dtype = np.float32)
+    faiss.normalize_L2(embeddings)
+    rng = np.random.default_rng(seed)
+    held_out = np.zeros(len(embeddings), dtype = bool)
+    held_out[rng.choice(len(embeddings), min(n_queries, len(embeddings) // 2), replace = False)] = True
+    return embeddings[~held_out], embeddings[held_out]
+
+def similarity_profile(
+                        embeddings,
+                        user_ids,
+                        n_pairs = 20000,
+                        seed = 2,
+                        chunk_size = 16384
+                        ):
+    """
+    Mean cosine of same-user pairs, of random impostor pairs and of each
+    face's nearest other user. The nearest impostor is found a
+    `chunk_size` gallery slice at a time, so memory stays flat with the
+    gallery size.
+    """
+    rng = np.random.default_rng(seed)
+    a, b = rng.integers(0, len(embeddings), (2, n_pairs))
+    cosines = np.einsum('ij,ij->i', embeddings[a], embeddings[b])
+    impostor = cosines[user_ids[a] != user_ids[b]]
+
+    order = np.argsort(user_ids, kind = 'stable')
+    sorted_users = user_ids[order]
+    same_a = order[:-1][sorted_users[:-1] == sorted_users[1:]]
+    same_b = order[1:][sorted_users[:-1] == sorted_users[1:]]
+    genuine = np.einsum('ij,ij->i', embeddings[same_a[:n_pairs]], embeddings[same_b[:n_pairs]])
+
+    sample = rng.choice(len(embeddings), min(1000, len(embeddings)), replace = False)
+    sample_embeddings, sample_users = embeddings[sample], user_ids[sample]
+    hardest = np.full(len(sample), -1, dtype = np.float32)
+    for start in range(0, len(embeddings), chunk_size):
+        similarities = sample_embeddings @ embeddings[start:start + chunk_size].T
+        similarities[sample_users[:, None] == user_ids[None, start:start + chunk_size]] = -1
+        np.maximum(hardest, similarities.max(axis = 1), out = hardest)
+
+    profile = {
+        "genuine_cos": round(float(genuine.mean()), 3),
+        "impostor_cos": round(float(impostor.mean()), 3),
+        "impostor_cos_p99": round(float(np.percentile(impostor, 99)), 3),
+        "nearest_impostor_cos": round(float(hardest.mean()), 3),
+        }
+    print(profile)
+    return profile
+
+def query_latencies(
+                    faiss_index,
+                    probes,
+                    k = 5
+                    ):
+    # one probe per call, the way search_face_in_db sees a proctoring frame
+    latencies = np.empty(len(probes))
+    retrieved = np.empty((len(probes), k), dtype = np.int64)
+    for i in range(len(probes)):
+        start = time.perf_counter()
+        _, I = faiss_index.search(probes[i:i + 1], k)
+        latencies[i] = time.perf_counter() - start
+        retrieved[i] = I[0]
+    return latencies, retrieved
+
+def recall_at_k(
+                retrieved,
+                ground_truth
+                ):
+    hits = [len(set(r[r >= 0]) & set(g)) for r, g in zip(retrieved, ground_truth)]
+    return float(np.mean(hits)) / ground_truth.shape[1]
+
+def search_parameter(faiss_index):
+    base_index = faiss.downcast_index(faiss_index.index)
+    if hasattr(base_index, 'nprobe'):
+        return 'nprobe'
+    if hasattr(base_index, 'hnsw'):
+        return 'efSearch'
+    return None
+
+def benchmark_index_types(
+                        sizes,
+                        index_types = INDEX_TYPES,
+                        n_queries = 1000,
+                        k = 5,
+                        d = 512,
+                        max_train = 100000,
+                        nprobes = (4, 8, 16, 32, 64),
+                        ef_searches = (16, 32, 64, 128, 256),
+                        embeddings_path = None
+                        ):
+    """
+    Recall@k of each index type against exact search and per-probe latency,
+    over a sweep of nprobe (IVF) or efSearch (HNSW). The rows at the values
+    configured by FACE_INDEX_NPROBE / FACE_INDEX_EF_SEARCH are printed again
+    at the end with their recall drop vs Flat. With `embeddings_path` the
+    real embeddings in that .npy replace the synthetic ones and `sizes` is
+    ignored.
+    """
+    rows, tuned_rows = [], []
+    datasets = [None] if embeddings_path else sizes
+    for n_faces in datasets:
+        if embeddings_path:
+            embeddings, probes = load_face_embeddings(embeddings_path, n_queries)
+            n_faces, d = embeddings.shape
+        else:
+            embeddings, user_ids, centers = synthetic_face_embeddings(n_faces, d = d)
+            probes, _ = synthetic_probes(centers, n_queries)
+            similarity_profile(embeddings, user_ids)
+        ids = np.arange(n_faces, dtype = np.int64)
+
+        exact_index = faiss.IndexFlatIP(d)
+        exact_index.add(embeddings)
+        _, ground_truth = exact_index.search(probes, k)
+        del exact_index
+
+        parameter_space = faiss.ParameterSpace()
+        for index_type in index_types:
+            start = time.perf_counter()
+            faiss_index = new_face_index(d, index_type = index_type, train_embeddings = embeddings[:max_train])
+            faiss_index.add_with_ids(embeddings, ids)
+            build_time = time.perf_counter() - start
+
+            parameter = search_parameter(faiss_index)
+            values = {'nprobe': nprobes, 'efSearch': ef_searches}.get(parameter, [None])
+            tuned = {'nprobe': FACE_INDEX_NPROBE, 'efSearch': FACE_INDEX_EF_SEARCH}.get(parameter)
+            if (tuned is not None) and (tuned not in values):
+                values = sorted([*values, tuned])
+
+            for value in values:
+                if parameter is not None:
+                    parameter_space.set_index_parameter(faiss_index, parameter, value)
+                latencies, retrieved = query_latencies(faiss_index, probes, k = k)
+                recall = recall_at_k(retrieved, ground_truth)
+                row = {
+                    "n_faces": n_faces,
+                    "index_type": index_type,
+                    "built_as": type(faiss.downcast_index(faiss_index.index)).__name__,
+                    "build_s": round(build_time, 2),
+                    "search_parameter": f"{parameter}={value}" if parameter else None,
+                    f"recall@{k}": round(recall, 4),
+                    "recall_drop": round(1.0 - recall, 4),
+                    "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+                    "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 3),
+                    }
+                rows.append(row)
+                print(row)
+                if value == tuned or parameter is None:
+                    tuned_rows.append(row)
+            del faiss_index
+
+    print(f"At the configured nprobe={FACE_INDEX_NPROBE} / efSearch={FACE_INDEX_EF_SEARCH}, recall drop vs Flat:")
+    for row in tuned_rows:
+        print(f"  {row['n_faces']:>9} faces {row['index_type']:>8} : recall@{k} {row[f'recall@{k}']:.4f}, drop {row['recall_drop']:.4f}, p50 {row['p50_ms']} ms")
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Recall@k vs latency of the face index types on Facenet512-like synthetic or real 512-d embeddings")
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [1000, 10000, 100000, 1000000])
+    parser.add_argument('--index_types', nargs = '+', default = INDEX_TYPES, choices = INDEX_TYPES)
+    parser.add_argument('--n_queries', type = int, default = 1000)
+    parser.add_argument('--k', type = int, default = 5)
+    parser.add_argument('--nprobes', type = int, nargs = '+', default = [4, 8, 16, 32, 64])
+    parser.add_argument('--ef_searches', type = int, nargs = '+', default = [16, 32, 64, 128, 256])
+    parser.add_argument('--embeddings', default = None, help = "(n, d) .npy of real face embeddings, replaces the synthetic data")
+    args = parser.parse_args()
+
+    benchmark_index_types(
+                        args.sizes,
+                        index_types = args.index_types,
+                        n_queries = args.n_queries,
+                        k = args.k,
+                        nprobes = args.nprobes,
+                        ef_searches = args.ef_searches,
+                        embeddings_path = args.embeddings
+                        )
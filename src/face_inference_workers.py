@@ -0,0 +1,294 @@
+import os
+import time
+import queue
+import itertools
+import threading
+import multiprocessing
+import numpy as np
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeoutError
+from multiprocessing import shared_memory
+
+class FaceInferenceTimeout(Exception):
+    pass
+
+class FaceInferenceOverloaded(Exception):
+    pass
+
+def attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name = name, track = False)
+    except TypeError:
+        # before Python 3.13 attaching registers the block with the resource
+        # tracker, which would unlink it again when this worker exits
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name = name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+def worker_main(
+                requests,
+                results,
+                current = None
+                ):
+    """
+    Worker process loop. Importing the inference module loads MediaPipe and
+    connects the event sinks; the face embedder and the face index are
+    loaded before the first request is accepted. The id of the request in
+    hand is kept in the shared `current` value, which survives the worker
+    dying on it.
+    """
+    from src import face_monitoring_inference
+    from src.face_embedder import get_face_embedder
+
+    get_face_embedder()
+    face_monitoring_inference.get_face_index_manager().get()
+    results.put(("ready", os.getpid(), None))
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+
+        request_id, username, shm_name, shape, dtype, deadline = request
+        if (deadline is not None) and (time.time() > deadline):
+            results.put((request_id, "timeout", None))
+            continue
+        if current is not None:
+            current.value = request_id
+        try:
+            shm = attach_shared_memory(shm_name)
+            try:
+                image = np.ndarray(shape, dtype = dtype, buffer = shm.buf).copy()
+            finally:
+                shm.close()
+            results.put((request_id, "ok", face_monitoring_inference.face_image_inference(username, image)))
+        except Exception as e:
+            results.put((request_id, "error", f"{type(e).__name__}: {e}"))
+        if current is not None:
+            current.value = -1
+
+    # multiprocessing children exit without running atexit, flush the event buffers here
+    for sink in (getattr(face_monitoring_inference, "event_sink", None), getattr(face_monitoring_inference, "proctoring_counters", None)):
+        if sink is not None:
+            sink.close()
+
+class FaceInferenceWorkerPool:
+    """
+    N worker processes, each holding its own face embedder, FaceMesh pool
+    and face index, fed over an IPC queue. Frames travel through shared
+    memory: only the block name and shape go over the pipe. Each request
+    carries a deadline that the worker checks before starting and the caller
+    waits on. When `max_pending` requests are already queued, new ones are
+    rejected rather than left to pile up behind slow frames.
+
+    Workers load their models before reporting ready, see wait_ready. close()
+    lets them finish the queue and flush their event buffers; it has to run
+    before the interpreter exits, daemonic workers are killed otherwise.
+
+    The result thread also watches the workers. A worker that died fails
+    the request it was running and is replaced; requests it never picked up
+    stay queued for the others. A slot is respawned at most once every
+    `respawn_interval` seconds, so a worker that crashes on start does not
+    spin. Requests whose deadline passed
+    `expire_after` seconds ago are failed as well, so their shared memory
+    cannot leak.
+    """
+
+    def __init__(
+                self,
+                n_workers,
+                max_pending = 64,
+                default_deadline = 5.0,
+                expire_after = 30.0,
+                check_interval = 1.0,
+                respawn_interval = 10.0
+                ):
+        self.n_workers = n_workers
+        self.default_deadline = default_deadline
+        self.expire_after = expire_after
+        self.check_interval = check_interval
+        self.respawn_interval = respawn_interval
+
+        self._context = multiprocessing.get_context("spawn")
+        self._requests = self._context.Queue(maxsize = max_pending)
+        self._results = self._context.Queue()
+        # id of the request each worker is running, -1 when idle
+        self._current = [self._context.Value('q', -1, lock = False) for _ in range(n_workers)]
+        self._processes = [self._spawn(slot) for slot in range(n_workers)]
+        self._spawned_at = [time.time()] * n_workers
+
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._counters = {"submitted": 0, "completed": 0, "failed": 0, "timed_out": 0, "rejected": 0, "respawned": 0}
+        self._ready = set()
+        self._closing = False
+
+        self._dispatcher = threading.Thread(target = self._dispatch, name = "face-inference-results", daemon = True)
+        self._dispatcher.start()
+
+    def _spawn(self, slot):
+        self._current[slot].value = -1
+        process = self._context.Process(target = worker_main, args = (self._requests, self._results, self._current[slot]), daemon = True)
+        process.start()
+        return process
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _finish(
+                self,
+                request_id,
+                counter,
+                result = None,
+                exception = None
+                ):
+        with self._lock:
+            entry = self._pending.pop(request_id, None)
+        if entry is None:
+            return
+        future, shm, _ = entry
+        shm.close()
+        shm.unlink()
+        # counted only by whoever settles the future, a caller that gave up already counted its timeout
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            return
+        self._count(counter)
+
+    def _check_workers(self):
+        now = time.time()
+        for slot, process in enumerate(self._processes):
+            if process.is_alive() or self._closing:
+                continue
+            with self._lock:
+                self._ready.discard(process.pid)
+            lost = self._current[slot].value
+            if lost >= 0:
+                self._current[slot].value = -1
+                self._finish(lost, "failed", exception = RuntimeError(f"Face inference worker {process.pid} died"))
+            if now - self._spawned_at[slot] < self.respawn_interval:
+                continue
+            print(f"Face inference worker {process.pid} exited with code {process.exitcode}, starting a new one")
+            self._processes[slot] = self._spawn(slot)
+            self._spawned_at[slot] = now
+            self._count("respawned")
+
+        with self._lock:
+            expired = [request_id for request_id, (_, _, deadline) in self._pending.items() if now > deadline + self.expire_after]
+        for request_id in expired:
+            self._finish(request_id, "timed_out", exception = FaceInferenceTimeout("No result from the face inference workers"))
+
+    def _dispatch(self):
+        last_check = time.time()
+        while True:
+            if time.time() - last_check >= self.check_interval:
+                self._check_workers()
+                last_check = time.time()
+            try:
+                message = self._results.get(timeout = self.check_interval)
+            except queue.Empty:
+                continue
+            if message is None:
+                break
+
+            request_id, status, payload = message
+            if request_id == "ready":
+                with self._lock:
+                    self._ready.add(status)
+            elif status == "ok":
+                self._finish(request_id, "completed", result = payload)
+            elif status == "timeout":
+                self._finish(request_id, "timed_out", exception = FaceInferenceTimeout("Frame expired in the queue before a worker picked it up"))
+            else:
+                self._finish(request_id, "failed", exception = RuntimeError(payload))
+
+    def submit(
+            self,
+            username,
+            image,
+            deadline = None
+            ):
+        image = np.ascontiguousarray(image)
+        deadline = deadline if deadline is not None else time.time() + self.default_deadline
+
+        shm = shared_memory.SharedMemory(create = True, size = max(image.nbytes, 1))
+        np.ndarray(image.shape, dtype = image.dtype, buffer = shm.buf)[:] = image
+
+        request_id = next(self._ids)
+        future = Future()
+        with self._lock:
+            self._pending[request_id] = (future, shm, deadline)
+        try:
+            self._requests.put_nowait((request_id, username, shm.name, image.shape, image.dtype.str, deadline))
+        except queue.Full:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            shm.close()
+            shm.unlink()
+            self._count("rejected")
+            raise FaceInferenceOverloaded("Face inference queue is full")
+
+        self._count("submitted")
+        return future
+
+    def infer(
+            self,
+            username,
+            image,
+            timeout = None
+            ):
+        """Run face_image_inference in a worker and wait for it, up to `timeout` seconds."""
+        timeout = timeout if timeout is not None else self.default_deadline
+        future = self.submit(username, image, deadline = time.time() + timeout)
+        try:
+            return future.result(timeout = timeout)
+        except FutureTimeoutError:
+            # the worker still owns the frame; its late result is dropped by the dispatcher
+            if not future.cancel():
+                # the result landed just now
+                return future.result()
+            self._count("timed_out")
+            raise FaceInferenceTimeout(f"Face inference took longer than {timeout} seconds")
+
+    def wait_ready(
+                self,
+                timeout = None,
+                poll_interval = 0.5
+                ):
+        """Block until every worker has loaded its models, or `timeout` seconds pass. Returns whether they all did."""
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            with self._lock:
+                if len(self._ready) >= self.n_workers:
+                    return True
+            if (deadline is not None) and (time.time() >= deadline):
+                return False
+            time.sleep(poll_interval)
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._counters)
+            metrics["in_flight"] = len(self._pending)
+            metrics["workers_ready"] = len(self._ready)
+        metrics["workers_alive"] = sum(process.is_alive() for process in self._processes)
+        try:
+            metrics["queue_depth"] = self._requests.qsize()
+        except NotImplementedError:
+            # macOS has no sem_getvalue
+            metrics["queue_depth"] = None
+        return metrics
+
+    def close(self, timeout = 10.0):
+        self._closing = True
+        for _ in self._processes:
+            self._requests.put(None)
+        for process in self._processes:
+            process.join(timeout = timeout)
+        self._results.put(None)
+        self._dispatcher.join(timeout = timeout)
@@ -0,0 +1,118 @@
+import time
+import argparse
+import numpy as np
+from src.face_index import FaceIndexSnapshot, new_face_index
+from src.face_index_benchmark import synthetic_face_embeddings, synthetic_probes
+
+def synthetic_snapshot(
+                        n_faces,
+                        d = 512,
+                        faces_per_user = 5,
+                        templates_per_user = 1,
+                        index_type = "Flat"
+                        ):
+    embeddings, user_ids, centers = synthetic_face_embeddings(n_faces, d = d, faces_per_user = faces_per_user)
+    ids = np.arange(n_faces, dtype = np.int64)
+    faiss_index = new_face_index(d, index_type = index_type, train_embeddings = embeddings[:100000])
+    faiss_index.add_with_ids(embeddings, ids)
+
+    # zero-padded, so the sorted names keep the order of the user ids
+    user_names = np.asarray([f"user{user_id:08d}" for user_id in user_ids], dtype = str)
+    snapshot = FaceIndexSnapshot(
+                                faiss_index,
+                                user_names,
+                                np.zeros((n_faces, 4), dtype = np.int64),
+                                np.ones(n_faces),
+                                embeddings = embeddings,
+                                ids = ids,
+                                templates_per_user = templates_per_user
+                                )
+    return snapshot, centers
+
+def timed_per_probe(match, probes):
+    # one face per call, the way a proctoring frame usually arrives
+    latencies = np.empty(len(probes))
+    codes = np.empty(len(probes), dtype = np.int64)
+    for i in range(len(probes)):
+        start = time.perf_counter()
+        codes[i] = match(probes[i:i + 1])
+        latencies[i] = time.perf_counter() - start
+    return codes, latencies
+
+def benchmark_match_stages(
+                            sizes,
+                            n_queries = 1000,
+                            faces_per_user = 5,
+                            templates_per_user = 1,
+                            threshold = 0.5,
+                            margin = 0.1,
+                            noise = 0.9
+                            ):
+    """
+    Top-1 accuracy and per-probe latency of the flat vote and of the
+    template stage. The probes come from the Facenet512-like generator with
+    more noise than the enrolled faces, as webcam frames are worse than
+    profile photos. Look-alike users put part of them within `margin` and
+    the template stage re-checks those against the raw embeddings. Both
+    stages are reported over all probes, the re-checked ones and the rest.
+    """
+    rows = []
+    for n_faces in sizes:
+        snapshot, centers = synthetic_snapshot(n_faces, faces_per_user = faces_per_user, templates_per_user = templates_per_user)
+        probes, probe_users = synthetic_probes(centers, n_queries, noise = noise)
+        expected = snapshot.identities.searchsorted(np.asarray([f"user{user_id:08d}" for user_id in probe_users], dtype = str))
+
+        start = time.perf_counter()
+        snapshot.templates()
+        template_build_time = time.perf_counter() - start
+
+        def vote(probe):
+            D, I = snapshot.index.search(probe, 5)
+            return snapshot.vote(D, I)[0][0]
+
+        def templates(probe):
+            return snapshot.match_templates(probe, threshold = threshold, margin = margin)[0][0]
+
+        _, _, rechecked = snapshot.match_templates(probes, threshold = threshold, margin = margin)
+        for stage, match in (("vote", vote), ("templates", templates)):
+            codes, latencies = timed_per_probe(match, probes)
+            for probe_set, mask in (("all", np.ones(len(probes), dtype = bool)), ("rechecked", rechecked), ("not_rechecked", ~rechecked)):
+                if not mask.any():
+                    continue
+                row = {
+                    "n_faces": n_faces,
+                    "stage": stage,
+                    "probes": probe_set,
+                    "n_probes": int(mask.sum()),
+                    "searched": snapshot.index.ntotal if stage == "vote" else snapshot.templates()[0].ntotal,
+                    "top1_accuracy": round(float(np.mean(codes[mask] == expected[mask])), 4),
+                    "p50_ms": round(float(np.percentile(latencies[mask], 50)) * 1000, 3),
+                    "p99_ms": round(float(np.percentile(latencies[mask], 99)) * 1000, 3),
+                    }
+                if (stage == "templates") and (probe_set == "all"):
+                    row["rechecked"] = round(float(rechecked.mean()), 4)
+                    row["build_s"] = round(template_build_time, 2)
+                rows.append(row)
+                print(row)
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Top-1 accuracy and latency of the flat vote vs per-user templates on Facenet512-like synthetic 512-d embeddings")
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [1000, 10000, 100000])
+    parser.add_argument('--n_queries', type = int, default = 1000)
+    parser.add_argument('--faces_per_user', type = int, default = 5)
+    parser.add_argument('--templates_per_user', type = int, default = 1)
+    parser.add_argument('--threshold', type = float, default = 0.5)
+    parser.add_argument('--margin', type = float, default = 0.1)
+    parser.add_argument('--noise', type = float, default = 0.9, help = "probe noise, webcam frames are noisier than the 0.65 of enrollment photos")
+    args = parser.parse_args()
+
+    benchmark_match_stages(
+                            args.sizes,
+                            n_queries = args.n_queries,
+                            faces_per_user = args.faces_per_user,
+                            templates_per_user = args.templates_per_user,
+                            threshold = args.threshold,
+                            margin = args.margin,
+                            noise = args.noise
+                            )
@@ -0,0 +1,136 @@
+import queue
+import threading
+import mediapipe as mp
+from contextlib import contextmanager
+from collections import OrderedDict
+
+def new_face_mesh(
+                static_image_mode,
+                max_num_faces,
+                min_detection_confidence = 0.5,
+                min_tracking_confidence = 0.5
+                ):
+    return mp.solutions.face_mesh.FaceMesh(
+                                            static_image_mode=static_image_mode,
+                                            max_num_faces=max_num_faces,
+                                            min_detection_confidence=min_detection_confidence,
+                                            min_tracking_confidence=min_tracking_confidence
+                                            )
+
+class FaceMeshPool:
+    """
+    Bounded pool of interchangeable FaceMesh instances. A FaceMesh graph is
+    not safe to call from two threads at once, so each request borrows one
+    for the duration of a process() call. Instances are created lazily up to
+    `size`; after that, borrowers wait up to `timeout` seconds for one to be
+    returned.
+    """
+
+    def __init__(
+                self,
+                size,
+                static_image_mode = True,
+                max_num_faces = 1,
+                timeout = 30.0,
+                min_detection_confidence = 0.5
+                ):
+        self.size = size
+        self.static_image_mode = static_image_mode
+        self.max_num_faces = max_num_faces
+        self.timeout = timeout
+        self.min_detection_confidence = min_detection_confidence
+
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return new_face_mesh(self.static_image_mode, self.max_num_faces, self.min_detection_confidence)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout = self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No FaceMesh instance free after {self.timeout} seconds")
+
+    @contextmanager
+    def borrow(self):
+        face_mesh = self._acquire()
+        try:
+            yield face_mesh
+        finally:
+            self._idle.put(face_mesh)
+
+class FaceMeshStreams:
+    """
+    One tracking-mode FaceMesh per video stream (e.g. per exam session), so
+    landmark tracking state never leaks between candidates. Frames of one
+    stream are processed in order under the stream's lock. At most
+    `max_streams` instances are kept; the least recently used is closed.
+    """
+
+    def __init__(
+                self,
+                max_streams = 32,
+                max_num_faces = 1,
+                min_detection_confidence = 0.5
+                ):
+        self.max_streams = max_streams
+        self.max_num_faces = max_num_faces
+        self.min_detection_confidence = min_detection_confidence
+
+        self._streams = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, stream_key):
+        with self._lock:
+            stream = self._streams.get(stream_key)
+            if stream is None:
+                stream = {"face_mesh": new_face_mesh(False, self.max_num_faces, self.min_detection_confidence), "lock": threading.Lock()}
+                self._streams[stream_key] = stream
+            self._streams.move_to_end(stream_key)
+
+            evicted = []
+            while len(self._streams) > self.max_streams:
+                evicted.append(self._streams.popitem(last = False)[1])
+
+        for old_stream in evicted:
+            with old_stream["lock"]:
+                old_stream["face_mesh"].close()
+                old_stream["closed"] = True
+        return stream
+
+    @contextmanager
+    def borrow(self, stream_key):
+        while True:
+            stream = self._lookup(stream_key)
+            with stream["lock"]:
+                # evicted between lookup and use, look it up again so the new instance is registered
+                if stream.get("closed"):
+                    continue
+                yield stream["face_mesh"]
+                return
+
+    def close(self, stream_key):
+        with self._lock:
+            stream = self._streams.pop(stream_key, None)
+        if stream is not None:
+            with stream["lock"]:
+                stream["face_mesh"].close()
+                stream["closed"] = True
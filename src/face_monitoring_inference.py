@@ -1,12 +1,37 @@
 import cv2 as cv
 import cv2, time
 import numpy as np
-import pandas as pd
 import yaml, pymongo
 import mediapipe as mp
-import faiss, glob, os
+import faiss, os
+import threading
+import functools
 from deepface import DeepFace
-from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta, timezone
+from src.face_session_tracker import FaceSessionTracker, box_iou
+from src.face_frame_cache import FrameHashCache, dct_hash
+from src.face_embedder import get_face_embedder
+from src.face_mesh_pool import FaceMeshPool, FaceMeshStreams
+from src.face_events import (
+                            ProctoringEventSink,
+                            RollingProctoringCounters,
+                            ensure_ffeatures_collection,
+                            RECORDING_FEATURES_COLLECTION,
+                            )
+from src.face_index import (
+                            FaceIndexManager,
+                            build_face_index_bulk,
+                            enroll_user_faces,
+                            remove_user_faces,
+                            load_face_index_pair,
+                            FACE_INDEX_MMAP,
+                            face_index_snapshot_dir,
+                            publish_face_index_snapshot,
+                            load_face_index_snapshot,
+                            FACE_MATCH_STAGE,
+                            FACE_DETECTOR_BACKENDS,
+                            )
 
 with open('secrets.yaml') as f:
     secrets = yaml.load(f, Loader=yaml.FullLoader)
@@ -16,16 +41,36 @@ os.environ["MONGO_DB_URI"] = secrets['MONGO_DB_URI']
 try:
     client = pymongo.MongoClient(os.environ["MONGO_DB_URI"])
     db = client['Elearning']
-    ffeatures_collection = db['ffeatures']
+    # time-series collection keyed by exp_username, see src/ffeatures_backfill.py for older 'ffeatures' data
+    ffeatures_collection = ensure_ffeatures_collection(db)
+    recording_features_collection = ensure_ffeatures_collection(db, RECORDING_FEATURES_COLLECTION)
+    # per-frame events are queued and written in bulk off the request path
+    event_sink = ProctoringEventSink(ffeatures_collection).start()
+    # per-minute rolling counts behind face_analysis, so dashboard polls do not rescan events
+    proctoring_counters = RollingProctoringCounters(db['ffeatures_counters']).start()
     print("Connected to MongoDB")
     
 except Exception as e:
     print(e)
 
-face_mesh = mp.solutions.face_mesh.FaceMesh(
-                                            min_detection_confidence=0.5, 
-                                            min_tracking_confidence=0.5
-                                            )
+# FaceMesh is the only detector on the proctoring path, so it has to see everyone in the frame
+FACE_MESH_MAX_FACES = 5
+# faces under this detection confidence are not identified; FaceMesh applies it
+# itself as min_detection_confidence, the other detectors through their scores
+FACE_CONFIDENCE_THRESHOLD = 0.8
+
+# API requests are unrelated stills, so they borrow static-image instances;
+# webcam streams get a tracking-mode instance of their own
+face_mesh_pool = FaceMeshPool(
+                            size = int(os.environ.get("FACE_MESH_POOL_SIZE", os.cpu_count() or 1)),
+                            static_image_mode = True,
+                            max_num_faces = FACE_MESH_MAX_FACES,
+                            min_detection_confidence = FACE_CONFIDENCE_THRESHOLD
+                            )
+face_mesh_streams = FaceMeshStreams(
+                                    max_num_faces = FACE_MESH_MAX_FACES,
+                                    min_detection_confidence = FACE_CONFIDENCE_THRESHOLD
+                                    )
 
 mp_drawing = mp.solutions.drawing_utils
 drawing_spec = mp_drawing.DrawingSpec(
@@ -35,6 +80,11 @@ drawing_spec = mp_drawing.DrawingSpec(
                                     )
 p_face_mesh = mp.solutions.face_mesh
 
+# remembers verified identities per exam session so steady frames skip the embedder
+session_tracker = FaceSessionTracker()
+# near-identical consecutive webcam frames reuse the previous result, FRAME_HASH_THRESHOLD=-1 turns this off
+frame_hash_cache = FrameHashCache(threshold = int(os.environ.get("FRAME_HASH_THRESHOLD", "4")))
+
 models = [
         "VGG-Face", 
         "Facenet", 
@@ -48,51 +98,84 @@ models = [
         "GhostFaceNet",
         ]
 
-def head_pose_inference(
+# facemesh keeps detection, pose and the embedder crop in one FaceMesh pass;
+# any DeepFace detector finds the faces and FaceMesh only adds their pose
+FACE_DETECTOR_BACKEND = os.environ.get("FACE_DETECTOR_BACKEND", "facemesh")
+if FACE_DETECTOR_BACKEND not in ["facemesh"] + FACE_DETECTOR_BACKENDS:
+    raise ValueError(f"FACE_DETECTOR_BACKEND must be facemesh or one of {FACE_DETECTOR_BACKENDS}, not {FACE_DETECTOR_BACKEND}")
+
+# nose tip, eye corners, mouth corners and chin, in ascending order so the nose comes first
+POSE_LANDMARK_IDS = [1, 33, 61, 199, 263, 291]
+# outer and inner corners of the eye on the left and on the right of the image
+LEFT_EYE_LANDMARK_IDS = [33, 133]
+RIGHT_EYE_LANDMARK_IDS = [263, 362]
+
+def landmarks_to_array(face_landmarks):
+    return np.array([(lm.x, lm.y, lm.z) for lm in face_landmarks.landmark], dtype = np.float64)
+
+@functools.lru_cache(maxsize = 16)
+def camera_matrices(img_h, img_w):
+    focal_length = 1 * img_w
+    cam_matrix = np.array([[focal_length,0,img_h/2],
+                          [0,focal_length,img_w/2],
+                          [0,0,1]])
+    distortion_matrix = np.zeros((4,1),dtype=np.float64)
+    # shared between frames of the same resolution
+    cam_matrix.flags.writeable = False
+    distortion_matrix.flags.writeable = False
+    return cam_matrix, distortion_matrix
+
+def head_pose_label(x, y):
+    if y < -10:
+        return "Looking Left"
+    elif y > 10:
+        return "Looking Right"
+    elif x < -10:
+        return "Looking Down"
+    elif x > 10:
+        return "Looking Up"
+    return "Forward"
+
+def estimate_head_pose(
                         image,
-                        image_flag = False
+                        image_flag = False,
+                        stream_key = None
                         ):
-    start = time.time()
-
+    """
+    Pose only, no drawing. Returns one dict per face with the pose label,
+    the (x, y, z) angles, the centroid of the pose landmarks and what
+    draw_head_pose needs to render the face. Frames of a continuous stream
+    pass a `stream_key` to get landmark tracking across frames.
+    """
     if image_flag:
         image = cv2.cvtColor(image,cv2.COLOR_BGR2RGB)
     else:
         image = cv2.cvtColor(cv2.flip(image,1),cv2.COLOR_BGR2RGB) 
     image.flags.writeable = False
 
-    results = face_mesh.process(image)
-    image.flags.writeable = True
-    image = cv2.cvtColor(image,cv2.COLOR_RGB2BGR)
+    if stream_key is None:
+        with face_mesh_pool.borrow() as face_mesh:
+            results = face_mesh.process(image)
+    else:
+        with face_mesh_streams.borrow(stream_key) as face_mesh:
+            results = face_mesh.process(image)
 
     img_h , img_w, img_c = image.shape
-    face_2d = []
-    face_3d = []
-
-    texts = []
-    face_centroids = []
+    poses = []
     if results.multi_face_landmarks:
-        for face_landmarks in results.multi_face_landmarks:
-            for idx, lm in enumerate(face_landmarks.landmark):
-                if idx == 33 or idx == 263 or idx ==1 or idx == 61 or idx == 291 or idx==199:
-                    if idx ==1:
-                        nose_2d = (lm.x * img_w,lm.y * img_h)
-                        nose_3d = (lm.x * img_w,lm.y * img_h,lm.z * 3000)
-                    x,y = int(lm.x * img_w),int(lm.y * img_h)
-
-                    face_2d.append([x,y])
-                    face_3d.append(([x,y,lm.z]))
-
-            face_2d = np.array(face_2d,dtype=np.float64)
-            face_3d = np.array(face_3d,dtype=np.float64)
+        landmark_arrays = np.stack([landmarks_to_array(face_landmarks) for face_landmarks in results.multi_face_landmarks])
+        pose_points = landmark_arrays[:, POSE_LANDMARK_IDS]
 
-            face_centroid = np.mean(face_2d,axis=0)
+        # all faces at once: pixel coordinates truncated as before, raw depth kept for z
+        face_2d = np.trunc(pose_points[:, :, :2] * (img_w, img_h))
+        face_3d = np.concatenate([face_2d, pose_points[:, :, 2:]], axis = 2)
+        face_centroids = face_2d.mean(axis = 1)
+        noses_2d = pose_points[:, 0, :2] * (img_w, img_h)
 
-            focal_length = 1 * img_w
-            cam_matrix = np.array([[focal_length,0,img_h/2],
-                                  [0,focal_length,img_w/2],
-                                  [0,0,1]])
-            distortion_matrix = np.zeros((4,1),dtype=np.float64)
-            success,rotation_vec,translation_vec = cv2.solvePnP(face_3d,face_2d,cam_matrix,distortion_matrix)
+        cam_matrix, distortion_matrix = camera_matrices(img_h, img_w)
+        for i, face_landmarks in enumerate(results.multi_face_landmarks):
+            # OpenCV has no batched PnP, the per-face work left is the solve itself
+            success,rotation_vec,translation_vec = cv2.solvePnP(face_3d[i],face_2d[i],cam_matrix,distortion_matrix)
 
             rmat,jac = cv2.Rodrigues(rotation_vec)
             angles,mtxR,mtxQ,Qx,Qy,Qz = cv2.RQDecomp3x3(rmat)
@@ -101,232 +184,514 @@ def head_pose_inference(
             y = angles[1] * 360
             z = angles[2] * 360
 
-            if y < -10:
-                text="Looking Left"
-            elif y > 10:
-                text="Looking Right"
-            elif x < -10:
-                text="Looking Down"
-            elif x > 10:
-                text="Looking Up"
-            else:
-                text="Forward"
-            texts.append(text)
-            face_centroids.append(face_centroid)
-            nose_3d_projection,jacobian = cv2.projectPoints(nose_3d,rotation_vec,translation_vec,cam_matrix,distortion_matrix)
-
-            p1 = (int(nose_2d[0]),int(nose_2d[1]))
-            p2 = (int(nose_2d[0] + y*10), int(nose_2d[1] -x *10))
-
-            cv2.line(image,p1,p2,(255,0,0),3)
-
-            cv2.putText(image,text,(0,30),cv2.FONT_HERSHEY_SIMPLEX,1.5,(255,0,0),3)
-            cv2.putText(image,"x: " + str(np.round(x,2)),(500,50),cv2.FONT_HERSHEY_SIMPLEX,1,(0,0,255),2)
-            cv2.putText(image,"y: "+ str(np.round(y,2)),(500,100),cv2.FONT_HERSHEY_SIMPLEX,1,(0,0,255),2)
-            cv2.putText(image,"z: "+ str(np.round(z, 2)), (500, 150), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-
-
-        end = time.time()
-        totalTime = end-start
+            poses.append({
+                        "text": head_pose_label(x, y),
+                        "angles": (x, y, z),
+                        "centroid": face_centroids[i],
+                        "nose_2d": noses_2d[i],
+                        "landmarks": face_landmarks,
+                        "landmark_array": landmark_arrays[i]
+                        })
+    return poses
+
+def draw_head_pose(
+                    image,
+                    poses,
+                    fps = None
+                    ):
+    for pose in poses:
+        x, y, z = pose["angles"]
+        nose_2d = pose["nose_2d"]
+        p1 = (int(nose_2d[0]),int(nose_2d[1]))
+        p2 = (int(nose_2d[0] + y*10), int(nose_2d[1] -x *10))
 
-        fps = 1/totalTime
-        print("FPS: ",fps)
+        cv2.line(image,p1,p2,(255,0,0),3)
 
-        cv2.putText(image,f'FPS: {int(fps)}',(20,450),cv2.FONT_HERSHEY_SIMPLEX,1.5,(0,255,0),2)
+        cv2.putText(image,pose["text"],(0,30),cv2.FONT_HERSHEY_SIMPLEX,1.5,(255,0,0),3)
+        cv2.putText(image,"x: " + str(np.round(x,2)),(500,50),cv2.FONT_HERSHEY_SIMPLEX,1,(0,0,255),2)
+        cv2.putText(image,"y: "+ str(np.round(y,2)),(500,100),cv2.FONT_HERSHEY_SIMPLEX,1,(0,0,255),2)
+        cv2.putText(image,"z: "+ str(np.round(z, 2)), (500, 150), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
 
         mp_drawing.draw_landmarks(
                                 image=image,
-                                landmark_list=face_landmarks,
+                                landmark_list=pose["landmarks"],
                                 connections=mp.solutions.face_mesh.FACEMESH_CONTOURS,
                                 connection_drawing_spec=drawing_spec,
                                 landmark_drawing_spec=drawing_spec
                                 )
-    return image, texts, face_centroids
 
-def extract_face_information_for_db(img_path):
-    face_objs = DeepFace.represent(
-                                img_path = img_path,
-                                model_name = models[2],
-                                enforce_detection = False
-                                )
-    img_path = img_path.replace("\\", "/")
-    user_name = img_path.split("/")[-2]
+    if poses and (fps is not None):
+        cv2.putText(image,f'FPS: {int(fps)}',(20,450),cv2.FONT_HERSHEY_SIMPLEX,1.5,(0,255,0),2)
+    return image
 
-    if len(face_objs) != 1:
-        if len(face_objs) == 0:
-            Warning(f"No faces detected in the image : {img_path}")
-        else:
-            Warning(f"Multiple faces detected in the image : {img_path}")
-        return None, None, None, None
+def head_pose_inference(
+                        image,
+                        image_flag = False,
+                        stream_key = None
+                        ):
+    """Pose estimation plus the overlay rendering, for visual inspection only."""
+    start = time.time()
+    poses = estimate_head_pose(image, image_flag = image_flag, stream_key = stream_key)
+    fps = 1/max(time.time() - start, 1e-6)
 
-    else:
-        facial_area = face_objs[0]['facial_area']
-        embeddings = face_objs[0]['embedding']
-        face_confidence = face_objs[0]['face_confidence']
-        x, y, w, h = facial_area['x'], facial_area['y'], facial_area['w'], facial_area['h']
+    image = image.copy() if image_flag else cv2.flip(image,1)
+    image = draw_head_pose(image, poses, fps = fps)
 
-    return embeddings, face_confidence, (x, y, w, h), user_name
+    texts = [pose["text"] for pose in poses]
+    face_centroids = [pose["centroid"] for pose in poses]
+    return image, texts, face_centroids
 
 def build_face_embedding_index(
                                 d = 512,
                                 face_index_path = 'models/face_index',
                                 face_image_dir = 'data/facedb/*/*.jpg',
                                 face_details_path = 'models/face_details.npz',
+                                return_details = False
                                 ):
     if (not os.path.exists(face_index_path)) or (not os.path.exists(face_details_path)):
-        faiss_index = faiss.index_factory(d, "Flat", faiss.METRIC_INNER_PRODUCT)
-
-        embeddings = []
-        user_names = []
-        facial_areas = []
-        face_confidences = []
-        
-        for idx, img_path in enumerate(glob.glob(face_image_dir)):
-            emb, face_confidence, facial_area, user_name = extract_face_information_for_db(img_path)
-            if emb is not None:
-                embeddings.append(emb)
-                user_names.append(user_name)
-                facial_areas.append(facial_area)
-                face_confidences.append(face_confidence)
-
-            if idx % 10 == 0:
-                print(f"Processed {idx}/{len(glob.glob(face_image_dir))} images")
-
-        embeddings = np.asarray(embeddings).astype('float32')
-        faiss.normalize_L2(embeddings)
-        faiss_index.add(embeddings)
-        faiss.write_index(faiss_index, face_index_path)
-
-        np.savez(
-                face_details_path, 
-                user_names=user_names, 
-                facial_areas=facial_areas, 
-                face_confidences=face_confidences
-                )
-        
-    else:
-        faiss_index = faiss.read_index(face_index_path)
-        face_details = np.load(face_details_path)
-        user_names = face_details['user_names']
-        facial_areas = face_details['facial_areas']
-        face_confidences = face_details['face_confidences']
-
-    return faiss_index, user_names, facial_areas, face_confidences
-
-def extract_face_information_for_inference(img_path):
-    face_objs = DeepFace.represent(
-                                img_path = img_path,
-                                model_name = models[2],
-                                enforce_detection = False
-                                )
-    img_path = img_path.replace("\\", "/")
-
-    embeddings = []
-    facial_areas = []
-    face_confidences = []
+        faiss_index, face_details = build_face_index_bulk(
+                                                        d = d,
+                                                        face_index_path = face_index_path,
+                                                        face_image_dir = face_image_dir,
+                                                        face_details_path = face_details_path,
+                                                        # every worker lands here at start-up, one of them builds
+                                                        only_if_missing = True,
+                                                        face_extractor = extract_enrollment_face,
+                                                        worker_initializer = init_enrollment_worker
+                                                        )
 
-    if len(face_objs) == 0:
-        Warning(f"No faces detected in the image : {img_path}")
     else:
-        for i in range(len(face_objs)):
-            embs = face_objs[i]['embedding']
-            facial_area = face_objs[i]['facial_area']
-            face_confidence = face_objs[i]['face_confidence']
-            x, y, w, h = facial_area['x'], facial_area['y'], facial_area['w'], facial_area['h']
-
-            embeddings.append(embs)
-            facial_areas.append((x, y, w, h))   
-            face_confidences.append(face_confidence)
+        faiss_index, face_details = load_face_index_pair(face_index_path, face_details_path)
+
+    if return_details:
+        return faiss_index, face_details
+    return faiss_index, face_details['user_names'], face_details['facial_areas'], face_details['face_confidences']
+
+def load_mapped_face_index(
+                            face_index_path = 'models/face_index',
+                            face_details_path = 'models/face_details.npz',
+                            ):
+    snapshot_dir = face_index_snapshot_dir(face_index_path)
+    if not os.path.exists(os.path.join(snapshot_dir, 'CURRENT')):
+        # first start in mmap mode, publish what the regular files hold
+        faiss_index, face_details = build_face_embedding_index(
+                                                            face_index_path = face_index_path,
+                                                            face_details_path = face_details_path,
+                                                            return_details = True
+                                                            )
+        # a cold build already published one
+        if not os.path.exists(os.path.join(snapshot_dir, 'CURRENT')):
+            publish_face_index_snapshot(faiss_index, face_details, snapshot_dir)
+    return load_face_index_snapshot(snapshot_dir)
+
+face_index_managers = {}
+face_index_managers_lock = threading.Lock()
+
+def get_face_index_manager(
+                            face_index_path = 'models/face_index',
+                            face_details_path = 'models/face_details.npz',
+                            ):
+    key = (face_index_path, face_details_path)
+    manager = face_index_managers.get(key)
+    if manager is None:
+        with face_index_managers_lock:
+            manager = face_index_managers.get(key)
+            if manager is None:
+                if FACE_INDEX_MMAP:
+                    loader = lambda: load_mapped_face_index(face_index_path, face_details_path)
+                    watch_paths = (os.path.join(face_index_snapshot_dir(face_index_path), 'CURRENT'),)
+                else:
+                    loader = lambda: build_face_embedding_index(
+                                                                face_index_path = face_index_path,
+                                                                face_details_path = face_details_path,
+                                                                return_details = True
+                                                                )
+                    watch_paths = None
+                manager = FaceIndexManager(face_index_path, face_details_path, loader = loader, watch_paths = watch_paths)
+                face_index_managers[key] = manager
+    return manager
+
+def enroll_face_in_db(
+                    username,
+                    img_paths,
+                    replace = False,
+                    face_index_path = 'models/face_index',
+                    face_details_path = 'models/face_details.npz',
+                    ):
+    return enroll_user_faces(
+                            username,
+                            img_paths,
+                            replace = replace,
+                            manager = get_face_index_manager(face_index_path, face_details_path),
+                            face_index_path = face_index_path,
+                            face_details_path = face_details_path,
+                            face_extractor = extract_enrollment_face
+                            )
+
+def remove_face_from_db(
+                        username,
+                        face_index_path = 'models/face_index',
+                        face_details_path = 'models/face_details.npz',
+                        ):
+    return remove_user_faces(
+                            username,
+                            manager = get_face_index_manager(face_index_path, face_details_path),
+                            face_index_path = face_index_path,
+                            face_details_path = face_details_path
+                            )
+
+def load_image(image):
+    # frames decoded from the request stream are passed through untouched
+    if isinstance(image, str):
+        return cv2.imread(image)
+    return image
+
+def extract_face_information_for_inference(image):
+    # the detect_faces/embed_faces crop the index was enrolled from
+    faces = [face for face in embed_faces(detect_faces(load_image(image))) if face["embedding"] is not None]
+    if len(faces) == 0:
+        img_path = image.replace("\\", "/") if isinstance(image, str) else "<in-memory frame>"
+        Warning(f"No faces detected in the image : {img_path}")
 
+    embeddings = [face["embedding"] for face in faces]
+    face_confidences = [face["face_confidence"] for face in faces]
+    facial_areas = [face["facial_area"] for face in faces]
     return embeddings, face_confidences, facial_areas
 
+def match_face_embeddings(
+                        embeddings,
+                        face_confidences,
+                        expected_username = None,
+                        verify_threshold = 0.5,
+                        face_index_path = 'models/face_index',
+                        face_details_path = 'models/face_details.npz',
+                        ):
+    """
+    Identify each embedding. Returns one (user_name, confidence) per
+    embedding, or None for faces under FACE_CONFIDENCE_THRESHOLD. FaceMesh
+    faces carry no score (nan), FaceMesh already dropped the ones under it.
+    """
+    snapshot = get_face_index_manager(
+                                    face_index_path = face_index_path,
+                                    face_details_path = face_details_path,
+                                    ).get()
+    matches = [None] * len(embeddings)
+    kept = np.flatnonzero(~(np.asarray(face_confidences, dtype = np.float64) < FACE_CONFIDENCE_THRESHOLD))
+    if len(kept) == 0:
+        return matches
+
+    # every face of the frame goes through one normalize and one search call
+    embs = np.asarray([embeddings[i] for i in kept], dtype = np.float32).reshape(len(kept), -1)
+    faiss.normalize_L2(embs)
+
+    # 1:1 fast path, only fall back to the 1:N search for faces that fail verification
+    unverified = np.ones(len(kept), dtype = bool)
+    if expected_username is not None:
+        scores = snapshot.verify_batch(expected_username, embs)
+        if scores is not None:
+            unverified = scores < verify_threshold
+            for j in np.flatnonzero(~unverified):
+                matches[kept[j]] = (expected_username, np.round(scores[j], 3))
+
+    if unverified.any():
+        if FACE_MATCH_STAGE == "templates":
+            # per-user templates first, raw embeddings only for borderline faces
+            winners, scores, _ = snapshot.match_templates(embs[unverified], threshold = verify_threshold)
+        else:
+            D, I = snapshot.index.search(embs[unverified], 5)
+            winners, scores = snapshot.vote(D, I)
+        for j, idx in enumerate(kept[unverified]):
+            if winners[j] >= 0:
+                matches[idx] = (str(snapshot.identities[winners[j]]), np.round(scores[j], 3))
+
+    return matches
+
 def search_face_in_db(
-                    img_path, 
+                    image, 
                     face_index_path = 'models/face_index',
                     face_details_path = 'models/face_details.npz',
+                    expected_username = None,
+                    verify_threshold = 0.5
                     ):
-    index, user_names, _, _ = build_face_embedding_index(
-                                                        face_index_path = face_index_path,
-                                                        face_details_path = face_details_path,
-                                                        )
-    embeddings, face_confidences, facial_areas = extract_face_information_for_inference(img_path)
+    embeddings, face_confidences, facial_areas = extract_face_information_for_inference(image)
+    matches = match_face_embeddings(
+                                    embeddings,
+                                    face_confidences,
+                                    expected_username = expected_username,
+                                    verify_threshold = verify_threshold,
+                                    face_index_path = face_index_path,
+                                    face_details_path = face_details_path
+                                    )
 
     retrieved_user_names = []
     retrieved_facial_areas = []
     retrieved_face_confidences = []
-
-    if embeddings is not None:
-        for idx, emb in enumerate(embeddings):
-            if face_confidences[idx] >= 0.8:
-                emb = np.array(emb).reshape(1, -1).astype('float32')
-                faiss.normalize_L2(emb)
-                D, I = index.search(emb, 5)
-                I = np.array(I).squeeze()
-                D = np.array(D).squeeze()
-                user_name_list = [user_names[i] for i in I]
-                user_name = max(set(user_name_list), key = user_name_list.count)
-                avg_confidence = np.mean([d for i, d in zip(I, D) if user_names[i] == user_name])
-                retrieved_face_confidences.append(np.round(avg_confidence, 3))
-                retrieved_facial_areas.append(facial_areas[idx])
-                retrieved_user_names.append(user_name)
+    for idx, match in enumerate(matches):
+        if match is not None:
+            retrieved_user_names.append(match[0])
+            retrieved_facial_areas.append(facial_areas[idx])
+            retrieved_face_confidences.append(match[1])
 
     return retrieved_user_names, retrieved_facial_areas, retrieved_face_confidences
 
 def eculedian_distance(x1, y1, x2, y2):
     return np.sqrt((x1 - x2)**2 + (y1 - y2)**2)
 
+def landmark_face_box(
+                    landmark_array,
+                    img_h,
+                    img_w,
+                    margin = 0.0
+                    ):
+    x_min, y_min = landmark_array[:, 0].min() * img_w, landmark_array[:, 1].min() * img_h
+    x_max, y_max = landmark_array[:, 0].max() * img_w, landmark_array[:, 1].max() * img_h
+    pad_x, pad_y = (x_max - x_min) * margin, (y_max - y_min) * margin
+
+    x1, y1 = max(int(x_min - pad_x), 0), max(int(y_min - pad_y), 0)
+    x2, y2 = min(int(x_max + pad_x), img_w), min(int(y_max + pad_y), img_h)
+    return x1, y1, x2 - x1, y2 - y1
+
+def detect_faces(
+                image,
+                image_flag = True,
+                stream_key = None,
+                detector_backend = None
+                ):
+    """
+    The single detection pass of the proctoring pipeline. FaceMesh finds the
+    faces and gives their pose; the face box and the crop handed to the
+    embedder come from the same landmarks, so pose and identity stay paired
+    without matching centroids afterwards. With another `detector_backend`
+    (FACE_DETECTOR_BACKEND by default) that detector's boxes are used and
+    each takes the pose of the FaceMesh face overlapping it most.
+    """
+    detector_backend = detector_backend or FACE_DETECTOR_BACKEND
+    poses = estimate_head_pose(image, image_flag = image_flag, stream_key = stream_key)
+    image = image if image_flag else cv2.flip(image, 1)
+    img_h, img_w = image.shape[:2]
+
+    if detector_backend != "facemesh":
+        return detect_faces_with_backend(image, poses, detector_backend)
+
+    faces = []
+    for pose in poses:
+        facial_area = landmark_face_box(pose["landmark_array"], img_h, img_w)
+        faces.append({
+                    "facial_area": facial_area,
+                    # FaceMesh does not score faces, the ones it returns passed FACE_CONFIDENCE_THRESHOLD
+                    "face_confidence": np.nan,
+                    "head_pose": pose["text"],
+                    "pose": pose,
+                    "crop": aligned_face_crop(image, pose["landmark_array"], landmark_face_box(pose["landmark_array"], img_h, img_w, margin = 0.1)),
+                    "embedding": None
+                    })
+    return faces
+
+def aligned_face_crop(
+                    image,
+                    landmark_array,
+                    face_box
+                    ):
+    # rotate the crop about the eye midpoint until the eyes are level, as DeepFace aligns its crops
+    x, y, w, h = face_box
+    crop = image[y:y+h, x:x+w]
+    if crop.size == 0:
+        return crop
+    img_h, img_w = image.shape[:2]
+    left_eye = landmark_array[LEFT_EYE_LANDMARK_IDS, :2].mean(axis = 0) * (img_w, img_h)
+    right_eye = landmark_array[RIGHT_EYE_LANDMARK_IDS, :2].mean(axis = 0) * (img_w, img_h)
+    angle = np.degrees(np.arctan2(right_eye[1] - left_eye[1], right_eye[0] - left_eye[0]))
+    eye_center = (left_eye + right_eye) / 2 - (x, y)
+    rotation = cv2.getRotationMatrix2D((float(eye_center[0]), float(eye_center[1])), float(angle), 1.0)
+    return cv2.warpAffine(crop, rotation, (w, h))
+
+def detect_faces_with_backend(
+                            image,
+                            poses,
+                            detector_backend
+                            ):
+    img_h, img_w = image.shape[:2]
+    face_objs = DeepFace.extract_faces(
+                                    img_path = image,
+                                    detector_backend = detector_backend,
+                                    enforce_detection = False,
+                                    align = False
+                                    )
+    pose_boxes = [landmark_face_box(pose["landmark_array"], img_h, img_w) for pose in poses]
+
+    faces = []
+    free_poses = list(range(len(poses)))
+    for face_obj in face_objs:
+        # without a face DeepFace returns the whole frame at confidence 0
+        if not face_obj["confidence"]:
+            continue
+        area = face_obj["facial_area"]
+        x, y = max(int(area["x"]), 0), max(int(area["y"]), 0)
+        w, h = min(int(area["w"]), img_w - x), min(int(area["h"]), img_h - y)
+
+        best_pose, best_iou = None, 0.3
+        for i in free_poses:
+            iou = box_iou((x, y, w, h), pose_boxes[i])
+            if iou >= best_iou:
+                best_pose, best_iou = i, iou
+        if best_pose is not None:
+            free_poses.remove(best_pose)
+
+        faces.append({
+                    "facial_area": (x, y, w, h),
+                    "face_confidence": float(face_obj["confidence"]),
+                    "head_pose": poses[best_pose]["text"] if best_pose is not None else "Unknown",
+                    "pose": poses[best_pose] if best_pose is not None else None,
+                    "crop": image[y:y+h, x:x+w],
+                    "embedding": None
+                    })
+    return faces
+
+def embed_faces(faces):
+    # backend picked by FACE_EMBEDDER_BACKEND, see src/face_embedder.py
+    embeddable = [face for face in faces if face["crop"].size > 0]
+    embeddings = get_face_embedder().embed([face["crop"] for face in embeddable])
+    for face, embedding in zip(embeddable, embeddings):
+        face["embedding"] = embedding
+    return faces
+
+def extract_enrollment_face(img_path):
+    """
+    Enrollment goes through the detect_faces/embed_faces crop the proctoring
+    frames get, so the index and the probes are embedded from the same kind
+    of crop. Same return as extract_face_information_for_db: (embedding,
+    face_confidence, facial_area, user_name), all None unless the image
+    holds exactly one face.
+    """
+    img_path = img_path.replace("\\", "/")
+    user_name = img_path.split("/")[-2]
+    image = cv2.imread(img_path)
+    if image is None:
+        print(f"Cannot read the image : {img_path}")
+        return None, None, None, None
+
+    faces = [face for face in detect_faces(image) if not (face["face_confidence"] < FACE_CONFIDENCE_THRESHOLD)]
+    if len(faces) != 1:
+        print(f"{len(faces)} faces detected in the image : {img_path}")
+        return None, None, None, None
+
+    face = embed_faces(faces)[0]
+    if face["embedding"] is None:
+        return None, None, None, None
+    return face["embedding"], face["face_confidence"], face["facial_area"], user_name
+
+def init_enrollment_worker():
+    # load the embedder once per bulk build worker
+    get_face_embedder()
+
+def identify_faces(
+                faces,
+                expected_username = None
+                ):
+    embedded = [face for face in faces if face["embedding"] is not None]
+    matches = match_face_embeddings(
+                                    [face["embedding"] for face in embedded],
+                                    [face["face_confidence"] for face in embedded],
+                                    expected_username = expected_username
+                                    )
+    for face, match in zip(embedded, matches):
+        if match is not None:
+            face["det_username"], face["match_confidence"] = match
+    return faces
+
+def analyze_frame(
+                image,
+                expected_username = None,
+                image_flag = True,
+                tracker = None,
+                stream_key = None,
+                detector_backend = None
+                ):
+    """
+    Pose for every face, identity for the faces that need it. With a tracker,
+    faces continuing a recently verified track reuse its identity and skip
+    the embedder; the session is keyed by `expected_username`.
+    """
+    faces = detect_faces(image, image_flag = image_flag, stream_key = stream_key, detector_backend = detector_backend)
+    pending = faces
+    if (tracker is not None) and (expected_username is not None):
+        pending = tracker.assign(expected_username, faces)
+
+    identify_faces(embed_faces(pending), expected_username = expected_username)
+
+    if (tracker is not None) and (expected_username is not None):
+        tracker.update(expected_username, faces)
+    return faces
+
+def build_proctoring_events(
+                            username,
+                            faces,
+                            timestamp = None
+                            ):
+    timestamp = timestamp if timestamp is not None else datetime.now(timezone.utc)
+
+    events = []
+    for face in faces:
+        if face.get("det_username") is None:
+            continue
+        x, y, w, h = face["facial_area"]
+        if (w * h) < 20000:
+            continue
+
+        if (face["det_username"] == username) and (face["match_confidence"] >= 0.5):
+            events.append({
+                        "exp_username": username,
+                        "det_username": face["det_username"],
+                        "head_pose": face["head_pose"],
+                        "face_confidence": float(face["match_confidence"]),
+                        "timestamp": timestamp
+                        })
+        else:
+            events.append({
+                        "exp_username": username,
+                        "det_username": "N/A",
+                        "head_pose": "Unknown",
+                        "face_confidence": "N/A",
+                        "timestamp": timestamp
+                        })
+    return events
+
+def draw_identities(
+                    image,
+                    faces,
+                    username
+                    ):
+    for face in faces:
+        if face.get("det_username") is None:
+            continue
+        x, y, w, h = face["facial_area"]
+        if (face["det_username"] == username) and (face["match_confidence"] >= 0.5):
+            cv.rectangle(image, (x, y), (x+w, y+h), (0, 255, 0), 2)
+            font = cv.FONT_HERSHEY_SIMPLEX
+            cv.putText(image, f'User: {face["det_username"]}', (x-30, y-40), font, 1, (0, 255, 0), 2)
+        else:
+            cv.rectangle(image, (x, y), (x+w, y+h), (0, 0, 255), 2)
+    return image
+
 def face_image_inference(
                         username,
-                        face_image_path
+                        face_image
                         ):
-    img = cv2.imread(face_image_path)
-    img_cp = img.copy()
-
-    img_cp, texts, face_centroids = head_pose_inference(img_cp, image_flag = True)
-
-    retrieved_user_names, retrieved_facial_areas, retrieved_face_confidences = search_face_in_db(face_image_path)
-    for i in range(len(retrieved_user_names)):
-        x, y, w, h = retrieved_facial_areas[i]
-        face_centhroid_bbox = (x + w//2, y + h//2)
-        face_area = w * h
-        if (face_area >= 20000):
-            timestamp = datetime.now()
-            timestamp = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-            if (retrieved_user_names[i] == username) and (retrieved_face_confidences[i] >= 0.5):
-                if (len(face_centroids) > 1) and (len(face_centroids) > 1):
-                    distances = [eculedian_distance(face_centhroid_bbox[0], face_centhroid_bbox[1], x, y) for x, y in face_centroids]
-                    head_pose_text = texts[np.argmin(distances)]
-                else:
-                    head_pose_text = texts[0]
-                    
-                ffeatures_collection.insert_one({
-                                                "exp_username": username,
-                                                "det_username": retrieved_user_names[i],
-                                                "head_pose": head_pose_text,
-                                                "face_confidence": float(retrieved_face_confidences[i]),
-                                                "timestamp": timestamp
-                                                })
-                det_username = retrieved_user_names[i]
-
-                cv.rectangle(img_cp, (x, y), (x+w, y+h), (0, 255, 0), 2)
-                font = cv.FONT_HERSHEY_SIMPLEX
-                cv.putText(img_cp, f'User: {retrieved_user_names[i]}', (x-30, y-40), font, 1, (0, 255, 0), 2)
-            else:
-                cv.rectangle(img_cp, (x, y), (x+w, y+h), (0, 0, 255), 2)
-                ffeatures_collection.insert_one({
-                                                "exp_username": username,
-                                                "det_username": "N/A",
-                                                "head_pose": "Unknown",
-                                                "face_confidence": "N/A",
-                                                "timestamp": timestamp
-                                                })
-                det_username = "N/A"
-                head_pose_text = "N/A"
-                
+    img = load_image(face_image)
+
+    frame_hash = dct_hash(img)
+    faces = frame_hash_cache.lookup(username, frame_hash) if frame_hash_cache.threshold >= 0 else None
+    if faces is None:
+        faces = analyze_frame(img, expected_username = username, tracker = session_tracker)
+        frame_hash_cache.store(username, frame_hash, faces)
+    events = build_proctoring_events(username, faces)
+    event_sink.put_many(events)
+    proctoring_counters.record(username, events)
+
+    head_pose_text, det_username = "N/A", "N/A"
+    if events and (events[-1]["det_username"] != "N/A"):
+        head_pose_text, det_username = events[-1]["head_pose"], events[-1]["det_username"]
     return head_pose_text, det_username
-    # cv.imshow('Face Monitoring Inference', img_cp)
-    # cv.waitKey(0)
-    # cv.destroyAllWindows()
 
 def video_face_inference(
                         username,
@@ -338,98 +703,138 @@ def video_face_inference(
         if not success:
             break
 
-        img_cp = img.copy()
-        img_cp_ = cv2.flip(img_cp, 1)
-        cv.imwrite("data/temp_dir/temp.jpg", img_cp_)
-
-        img_cp, texts, face_centroids = head_pose_inference(img_cp)
-
-        retrieved_user_names, retrieved_facial_areas, retrieved_face_confidences = search_face_in_db("data/temp_dir/temp.jpg")
-        for i in range(len(retrieved_user_names)):
-            x, y, w, h = retrieved_facial_areas[i]
-            face_centhroid_bbox = (x + w//2, y + h//2)
-            face_area = w * h
-            if (face_area >= 20000):
-                timestamp = datetime.now()
-                timestamp = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-                if (retrieved_user_names[i] == username) and (retrieved_face_confidences[i] >= 0.5):
-                    if (len(face_centroids) > 1) and (len(face_centroids) > 1):
-                        distances = [eculedian_distance(face_centhroid_bbox[0], face_centhroid_bbox[1], x, y) for x, y in face_centroids]
-                        head_pose_text = texts[np.argmin(distances)]
-                    elif len(face_centroids) == 1:
-                        head_pose_text = texts[0]
-
-                    else:
-                        head_pose_text = "UnKnown"
-
-                    ffeatures_collection.insert_one({
-                                                    "exp_username": username,
-                                                    "det_username": retrieved_user_names[i],
-                                                    "head_pose": head_pose_text,
-                                                    "face_confidence": float(retrieved_face_confidences[i]),
-                                                    "timestamp": timestamp
-                                                    })
-                
-                    cv.rectangle(img_cp, (x, y), (x+w, y+h), (0, 255, 0), 2)
-                    font = cv.FONT_HERSHEY_SIMPLEX
-                    cv.putText(img_cp, f'User: {retrieved_user_names[i]}', (x-30, y-40), font, 1, (0, 255, 0), 2)
-                else:
-                    cv.rectangle(img_cp, (x, y), (x+w, y+h), (0, 0, 255), 2)
-                    ffeatures_collection.insert_one({
-                                                    "exp_username": username,
-                                                    "det_username": "N/A",
-                                                    "head_pose": "Unknown",
-                                                    "face_confidence": "N/A",
-                                                    "timestamp": timestamp
-                                                    })
-                
+        start = time.time()
+        faces = analyze_frame(img, expected_username = username, image_flag = False, tracker = session_tracker, stream_key = username)
+        events = build_proctoring_events(username, faces)
+        event_sink.put_many(events)
+        proctoring_counters.record(username, events)
+
         if is_vis:
+            img_cp = draw_head_pose(cv2.flip(img, 1), [face["pose"] for face in faces if face["pose"] is not None], fps = 1/max(time.time() - start, 1e-6))
+            img_cp = draw_identities(img_cp, faces, username)
             cv.imshow('Face Monitoring Inference', img_cp)
             if cv.waitKey(5) & 0xFF == 27:
                 break
 
     cap.release()
     cv.destroyAllWindows()
+    face_mesh_streams.close(username)
+
+def format_face_analysis(
+                        n_total,
+                        n_detected,
+                        n_forward
+                        ):
+    detected_percentage = (n_detected/n_total)*100
+    forward_percentage = (n_forward/n_total)*100
+
+    detected_percentage = round(detected_percentage, 2)
+    forward_percentage = round(forward_percentage, 2)
+
+
+    detected_percentage = f"{detected_percentage} %"
+    forward_percentage = f"{forward_percentage} %"
+
+    return {
+            "detected_percentage": detected_percentage,
+            "forward_percentage": forward_percentage
+            }
 
 def face_analysis(
                 username,
                 x_min = 10
                 ):
-    current_time = datetime.now()
+    counts = proctoring_counters.window(username, x_min)
+    if (counts is not None) and (counts[0] > 0):
+        return format_face_analysis(*counts)
+
+    current_time = datetime.now(timezone.utc)
     current_time_minus_x = current_time - timedelta(minutes=x_min)
 
-    current_time = current_time.strftime("%Y-%m-%d %H:%M:%S")
-    current_time_minus_x = current_time_minus_x.strftime("%Y-%m-%d %H:%M:%S")
-
-    data_user = ffeatures_collection.find({
-                                        "exp_username": username,
-                                        "timestamp": {
-                                                    "$gte": current_time_minus_x,
-                                                    "$lt": current_time
-                                                    }
-                                        })
-    data_user = pd.DataFrame(list(data_user))
+    # counted inside MongoDB, only one summary document comes back
+    counts = list(ffeatures_collection.aggregate([
+                                                {"$match": {
+                                                            "exp_username": username,
+                                                            "timestamp": {
+                                                                        "$gte": current_time_minus_x,
+                                                                        "$lt": current_time
+                                                                        },
+                                                            # recordings reviewed before they got their own collection
+                                                            "recording_id": {"$exists": False}
+                                                            }},
+                                                {"$group": {
+                                                            "_id": None,
+                                                            "n_total": {"$sum": 1},
+                                                            "n_detected": {"$sum": {"$cond": [{"$eq": ["$det_username", username]}, 1, 0]}},
+                                                            "n_forward": {"$sum": {"$cond": [{"$eq": ["$head_pose", "Forward"]}, 1, 0]}}
+                                                            }}
+                                                ]))
     
-    if data_user.empty:
+    if len(counts) == 0:
         return None, None
     
     else:
-        data_user = data_user.drop(columns = ["_id", "exp_username", "face_confidence", "timestamp"])
-        n_forward = len(data_user[data_user["head_pose"] == "Forward"])
-        n_detected = len(data_user[data_user["det_username"] == username])
-        n_total = len(data_user)
-
-        detected_percentage = (n_detected/n_total)*100
-        forward_percentage = (n_forward/n_total)*100
-
-        detected_percentage = round(detected_percentage, 2)
-        forward_percentage = round(forward_percentage, 2)
-
-
-        detected_percentage = f"{detected_percentage} %"
-        forward_percentage = f"{forward_percentage} %"
+        return format_face_analysis(counts[0]["n_total"], counts[0]["n_detected"], counts[0]["n_forward"])
+
+def course_usernames(course_id):
+    """Usernames of the students enrolled in `course_id`, for cohort-wide monitoring."""
+    enrollments = db['enrollments'].find({"course_id": ObjectId(course_id)}, {"student_email": 1})
+    student_emails = [enrollment["student_email"] for enrollment in enrollments]
+    users = db['users'].find({"email": {"$in": student_emails}}, {"username": 1})
+    return [user["username"] for user in users if user.get("username")]
+
+def face_analysis_batch(
+                        usernames = None,
+                        course_id = None,
+                        x_min = 10,
+                        page = 1,
+                        page_size = None
+                        ):
+    """
+    face_analysis for a whole cohort, either an explicit list of usernames or
+    every student enrolled in `course_id`, from a single aggregation grouped
+    by candidate. Candidates are sorted by username and paged with
+    `page`/`page_size`; candidates with no events in the window get None.
+    """
+    if course_id is not None:
+        usernames = course_usernames(course_id)
+    usernames = sorted(set(usernames or []))
+
+    n_candidates = len(usernames)
+    if page_size:
+        usernames = usernames[(page - 1) * page_size:page * page_size]
+
+    current_time = datetime.now(timezone.utc)
+    current_time_minus_x = current_time - timedelta(minutes=x_min)
 
-        return {
-                "detected_percentage": detected_percentage,
-                "forward_percentage": forward_percentage
-                }
+    counts = ffeatures_collection.aggregate([
+                                            {"$match": {
+                                                        "exp_username": {"$in": usernames},
+                                                        "timestamp": {
+                                                                    "$gte": current_time_minus_x,
+                                                                    "$lt": current_time
+                                                                    },
+                                                        "recording_id": {"$exists": False}
+                                                        }},
+                                            {"$group": {
+                                                        "_id": "$exp_username",
+                                                        "n_total": {"$sum": 1},
+                                                        "n_detected": {"$sum": {"$cond": [{"$eq": ["$det_username", "$exp_username"]}, 1, 0]}},
+                                                        "n_forward": {"$sum": {"$cond": [{"$eq": ["$head_pose", "Forward"]}, 1, 0]}}
+                                                        }}
+                                            ])
+    counts = {count["_id"]: count for count in counts}
+
+    results = {}
+    for username in usernames:
+        if username in counts:
+            results[username] = format_face_analysis(counts[username]["n_total"], counts[username]["n_detected"], counts[username]["n_forward"])
+        else:
+            results[username] = None
+
+    return {
+            "results": results,
+            "page": page,
+            "page_size": page_size,
+            "total": n_candidates
+            }
@@ -0,0 +1,115 @@
+import time
+import threading
+
+def box_iou(box_a, box_b):
+    ax, ay, aw, ah = box_a
+    bx, by, bw, bh = box_b
+    inter_w = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    inter_h = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = inter_w * inter_h
+    union = aw * ah + bw * bh - inter
+    return inter / union if union > 0 else 0.0
+
+class FaceSessionTracker:
+    """
+    Per exam session (keyed by username) memory of who was verified where.
+
+    Faces in a new frame are matched to the previous frame's boxes by IoU.
+    A face that continues a track keeps the track's identity, so only its
+    head pose has to be recomputed. It is re-verified when the identity is
+    older than `identity_ttl` seconds or has been reused `spot_check_every`
+    frames in a row. A change in the number of faces, or any face without
+    a track, sends the whole frame back through recognition.
+    """
+
+    def __init__(
+                self,
+                iou_threshold = 0.5,
+                identity_ttl = 10.0,
+                spot_check_every = 15,
+                session_ttl = 600.0
+                ):
+        self.iou_threshold = iou_threshold
+        self.identity_ttl = identity_ttl
+        self.spot_check_every = spot_check_every
+        self.session_ttl = session_ttl
+
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        expired = [username for username, session in self._sessions.items() if now - session["last_seen"] > self.session_ttl]
+        for username in expired:
+            del self._sessions[username]
+
+    def assign(
+            self,
+            username,
+            faces
+            ):
+        """
+        Copy still-valid identities onto `faces` and return the faces that need
+        a fresh embedding and search.
+        """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(username)
+            tracks = list(session["tracks"]) if session is not None else []
+
+        for face in faces:
+            face["reused_identity"] = False
+        if (len(tracks) == 0) or (len(tracks) != len(faces)):
+            return list(faces)
+
+        pending = []
+        free_tracks = list(tracks)
+        for face in faces:
+            best_track, best_iou = None, self.iou_threshold
+            for track in free_tracks:
+                iou = box_iou(face["facial_area"], track["facial_area"])
+                if iou >= best_iou:
+                    best_track, best_iou = track, iou
+
+            if best_track is None:
+                return list(faces)
+            free_tracks.remove(best_track)
+
+            fresh = (now - best_track["verified_at"] < self.identity_ttl) and (best_track["reuses"] < self.spot_check_every)
+            if fresh and (best_track["det_username"] is not None):
+                face["det_username"] = best_track["det_username"]
+                face["match_confidence"] = best_track["match_confidence"]
+                face["reused_identity"] = True
+                face["track"] = best_track
+            else:
+                pending.append(face)
+        return pending
+
+    def update(
+            self,
+            username,
+            faces
+            ):
+        """Replace the session's tracks with this frame's faces once they are identified."""
+        now = time.time()
+        tracks = []
+        for face in faces:
+            if face.get("reused_identity"):
+                previous = face["track"]
+                verified_at, reuses = previous["verified_at"], previous["reuses"] + 1
+            else:
+                verified_at, reuses = now, 0
+            tracks.append({
+                        "facial_area": face["facial_area"],
+                        "det_username": face.get("det_username"),
+                        "match_confidence": face.get("match_confidence"),
+                        "verified_at": verified_at,
+                        "reuses": reuses
+                        })
+
+        with self._lock:
+            self._sessions[username] = {"tracks": tracks, "last_seen": now}
+
+    def reset(self, username):
+        with self._lock:
+            self._sessions.pop(username, None)
@@ -0,0 +1,252 @@
+import os
+import math
+import uuid
+import argparse
+import cv2 as cv
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from src.face_session_tracker import FaceSessionTracker
+from src.face_monitoring_inference import (
+                                            analyze_frame,
+                                            build_proctoring_events,
+                                            db,
+                                            face_mesh_pool,
+                                            recording_features_collection,
+                                            format_face_analysis,
+                                            )
+
+RECORDING_SAMPLE_FPS = float(os.environ.get("RECORDING_SAMPLE_FPS", "2"))
+RECORDING_INSERT_BATCH = 1000
+FACE_RECORDING_REVIEWS_COLLECTION = 'face_recording_reviews'
+
+# one recording at a time, a review already keeps every FaceMesh instance busy
+recording_review_executor = ThreadPoolExecutor(max_workers = 1)
+
+def recording_properties(video_path):
+    cap = cv.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f"Cannot open video {video_path}")
+    fps = cap.get(cv.CAP_PROP_FPS)
+    n_frames = int(cap.get(cv.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    # some containers do not carry a frame rate
+    if (not fps) or math.isnan(fps) or (fps <= 0):
+        fps = 30.0
+    return fps, n_frames
+
+def process_segment(
+                    video_path,
+                    username,
+                    start_frame,
+                    end_frame,
+                    step,
+                    fps,
+                    recording_start,
+                    recording_id
+                    ):
+    """
+    Decode frames [start_frame, end_frame) of the recording with a capture of
+    its own and analyze every `step`-th one. Skipped frames are only grabbed,
+    never converted to BGR. Identities are reused across sampled frames of
+    the segment through a tracker private to it.
+    """
+    cap = cv.VideoCapture(video_path)
+    if start_frame > 0:
+        cap.set(cv.CAP_PROP_POS_FRAMES, start_frame)
+    tracker = FaceSessionTracker()
+
+    samples, events = [], []
+    for frame_idx in range(start_frame, end_frame):
+        if not cap.grab():
+            break
+        if (frame_idx - start_frame) % step != 0:
+            continue
+        success, img = cap.retrieve()
+        if not success:
+            continue
+
+        offset = frame_idx / fps
+        faces = analyze_frame(img, expected_username = username, tracker = tracker)
+        frame_events = build_proctoring_events(username, faces, timestamp = recording_start + timedelta(seconds = offset))
+        for event in frame_events:
+            event["recording_id"] = recording_id
+        events.extend(frame_events)
+
+        samples.append({
+                        "second": int(offset),
+                        "n_faces": len(faces),
+                        "detected": any(event["det_username"] == username for event in frame_events),
+                        "head_pose": frame_events[-1]["head_pose"] if frame_events else "N/A"
+                        })
+    cap.release()
+    return samples, events
+
+def write_recording_events(events):
+    for start in range(0, len(events), RECORDING_INSERT_BATCH):
+        recording_features_collection.insert_many(events[start:start + RECORDING_INSERT_BATCH], ordered = False)
+
+def build_timeline(samples):
+    seconds = {}
+    for sample in samples:
+        seconds.setdefault(sample["second"], []).append(sample)
+
+    timeline = []
+    for second in sorted(seconds):
+        second_samples = seconds[second]
+        poses = Counter(sample["head_pose"] for sample in second_samples)
+        timeline.append({
+                        "second": second,
+                        "n_samples": len(second_samples),
+                        "n_detected": sum(sample["detected"] for sample in second_samples),
+                        "max_faces": max(sample["n_faces"] for sample in second_samples),
+                        "head_pose": poses.most_common(1)[0][0]
+                        })
+    return timeline
+
+def recorded_video_face_inference(
+                                username,
+                                video_path,
+                                sample_fps = RECORDING_SAMPLE_FPS,
+                                recording_start = None,
+                                workers = None,
+                                write_events = True,
+                                recording_id = None
+                                ):
+    """
+    Proctor an uploaded exam recording instead of the live webcam.
+
+    Frames are sampled at `sample_fps`. The recording is cut into one
+    contiguous segment per worker, and each segment is decoded and analyzed
+    in its own thread. Events are timestamped at `recording_start` plus the
+    frame's offset in the video, which defaults to the recording having just
+    ended. They are tagged with a recording_id and inserted in bulk into
+    their own collection, so neither face_analysis nor the live per-minute
+    counters see them. Returns a per-second timeline with the summary
+    face_analysis would give for the whole recording.
+    """
+    fps, n_frames = recording_properties(video_path)
+    step = max(1, int(round(fps / sample_fps)))
+    duration = n_frames / fps
+    if recording_start is None:
+        recording_start = datetime.now(timezone.utc) - timedelta(seconds = duration)
+    recording_id = recording_id or uuid.uuid4().hex
+
+    workers = workers or face_mesh_pool.size
+    if n_frames > 0:
+        # segment boundaries on the sampling grid, so the sampled frames match a single pass
+        n_steps = math.ceil(n_frames / step)
+        steps_per_segment = max(1, math.ceil(n_steps / workers))
+        bounds = [
+                (start, min(start + steps_per_segment * step, n_frames))
+                for start in range(0, n_frames, steps_per_segment * step)
+                ]
+    else:
+        # frame count unknown (e.g. streamed webm), decode in one pass to the end
+        bounds = [(0, 2**62)]
+
+    with ThreadPoolExecutor(max_workers = max(1, len(bounds))) as executor:
+        results = list(executor.map(
+                                    lambda bound: process_segment(video_path, username, bound[0], bound[1], step, fps, recording_start, recording_id),
+                                    bounds
+                                    ))
+
+    samples = [sample for segment_samples, _ in results for sample in segment_samples]
+    events = [event for _, segment_events in results for event in segment_events]
+    if write_events and events:
+        write_recording_events(events)
+
+    if (n_frames <= 0) and samples:
+        duration = samples[-1]["second"] + 1
+
+    n_detected = sum(event["det_username"] == username for event in events)
+    n_forward = sum(event["head_pose"] == "Forward" for event in events)
+    return {
+            "recording_id": recording_id,
+            "username": username,
+            "duration_s": round(duration, 2),
+            "fps": fps,
+            "sample_fps": fps / step,
+            "n_frames_processed": len(samples),
+            "n_events": len(events),
+            "summary": format_face_analysis(len(events), n_detected, n_forward) if events else None,
+            "timeline": build_timeline(samples)
+            }
+
+def set_recording_review(recording_id, **fields):
+    db[FACE_RECORDING_REVIEWS_COLLECTION].update_one({"recording_id": recording_id}, {"$set": fields})
+
+def run_recording_review(
+                        recording_id,
+                        username,
+                        video_path,
+                        sample_fps,
+                        recording_start,
+                        delete_video
+                        ):
+    set_recording_review(recording_id, status = "processing", started_at = datetime.now(timezone.utc))
+    try:
+        result = recorded_video_face_inference(
+                                            username,
+                                            video_path,
+                                            sample_fps = sample_fps,
+                                            recording_start = recording_start,
+                                            recording_id = recording_id
+                                            )
+        set_recording_review(recording_id, status = "done", result = result, finished_at = datetime.now(timezone.utc))
+    except ValueError as e:
+        set_recording_review(recording_id, status = "failed", error = f"Unreadable video file : {e}", finished_at = datetime.now(timezone.utc))
+    except Exception as e:
+        print(f"Reviewing recording {recording_id} of {username} failed : {e}")
+        set_recording_review(recording_id, status = "failed", error = str(e), finished_at = datetime.now(timezone.utc))
+    finally:
+        if delete_video and os.path.exists(video_path):
+            os.remove(video_path)
+
+def submit_recording_review(
+                            username,
+                            video_path,
+                            sample_fps = RECORDING_SAMPLE_FPS,
+                            recording_start = None,
+                            delete_video = True
+                            ):
+    """
+    Queue recorded_video_face_inference for `video_path` and return its
+    recording_id at once. Progress and the report are kept in the
+    face_recording_reviews collection, readable from any process through
+    recording_review. A review still running when the process stops is
+    left as "processing" and has to be submitted again.
+    """
+    recording_id = uuid.uuid4().hex
+    reviews = db[FACE_RECORDING_REVIEWS_COLLECTION]
+    reviews.create_index("recording_id", unique = True)
+    reviews.insert_one({
+                        "recording_id": recording_id,
+                        "username": username,
+                        "status": "queued",
+                        "submitted_at": datetime.now(timezone.utc)
+                        })
+    recording_review_executor.submit(run_recording_review, recording_id, username, video_path, sample_fps, recording_start, delete_video)
+    return recording_id
+
+def recording_review(recording_id):
+    return db[FACE_RECORDING_REVIEWS_COLLECTION].find_one({"recording_id": recording_id}, {"_id": 0})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Proctor a recorded exam video")
+    parser.add_argument('--username', type = str, required = True)
+    parser.add_argument('--video_path', type = str, required = True)
+    parser.add_argument('--sample_fps', type = float, default = RECORDING_SAMPLE_FPS)
+    parser.add_argument('--workers', type = int, default = None)
+    parser.add_argument('--dry_run', action = 'store_true', help = "do not write events to MongoDB")
+    args = parser.parse_args()
+
+    report = recorded_video_face_inference(
+                                        args.username,
+                                        args.video_path,
+                                        sample_fps = args.sample_fps,
+                                        workers = args.workers,
+                                        write_events = not args.dry_run
+                                        )
+    print({key: value for key, value in report.items() if key != "timeline"})
@@ -0,0 +1,107 @@
+import os
+import yaml
+import argparse
+import pymongo
+from datetime import datetime, timedelta, timezone
+from pymongo.errors import OperationFailure
+from src.face_events import ensure_ffeatures_collection, FFEATURES_RAW_TTL_DAYS
+
+MIGRATION_ID = 'ffeatures_timestamp_backfill'
+
+def parse_legacy_timestamp(timestamp):
+    # legacy events were written with the server's local datetime.now()
+    return datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").astimezone(timezone.utc)
+
+def backfill_ffeatures(
+                        db,
+                        source_name = 'ffeatures',
+                        batch_size = 1000
+                        ):
+    """
+    Copy string-timestamped events from `source_name` into the time-series
+    event collection with BSON datetimes. Progress is checkpointed by source
+    _id in the 'migrations' collection after every batch, so an interrupted
+    run resumes from the last completed batch. Copies carry their source
+    _id as `source_id`; a batch inserted just before a crash, but not yet
+    checkpointed, is recognized by it and not copied twice. The source
+    collection is left untouched.
+
+    The event collection expires events FFEATURES_RAW_TTL_DAYS after their
+    timestamp, so older events are deleted again shortly after the copy.
+    """
+    source = db[source_name]
+    target = ensure_ffeatures_collection(db)
+    migrations = db['migrations']
+    try:
+        target.create_index("source_id")
+    except OperationFailure as e:
+        print(f"No index on source_id ({e}), looking up copied events will scan {target.name}")
+
+    state = migrations.find_one({"_id": MIGRATION_ID}) or {}
+    query = {"timestamp": {"$type": "string"}}
+    copied_query = {"source_id": {"$exists": True}}
+    if state.get("last_id") is not None:
+        query["_id"] = {"$gt": state["last_id"]}
+        copied_query = {"source_id": {"$gt": state["last_id"]}}
+    # copied by a run that stopped before checkpointing them
+    already_copied = {event["source_id"] for event in target.find(copied_query, {"_id": 0, "source_id": 1})}
+    if already_copied:
+        print(f"{len(already_copied)} events were copied after the last checkpoint, skipping them")
+
+    expire_before = datetime.now(timezone.utc) - timedelta(days = FFEATURES_RAW_TTL_DAYS)
+    n_copied = state.get("n_copied", 0) + len(already_copied)
+    n_skipped = state.get("n_skipped", 0)
+    n_expiring = 0
+    batch = []
+    last_id = None
+    for event in source.find(query).sort("_id", pymongo.ASCENDING).batch_size(batch_size):
+        last_id = event.pop("_id")
+        if last_id in already_copied:
+            continue
+        try:
+            event["timestamp"] = parse_legacy_timestamp(event["timestamp"])
+        except ValueError:
+            n_skipped += 1
+            continue
+        if event["timestamp"] < expire_before:
+            n_expiring += 1
+        event["source_id"] = last_id
+        batch.append(event)
+
+        if len(batch) >= batch_size:
+            target.insert_many(batch, ordered = False)
+            n_copied += len(batch)
+            batch = []
+            migrations.update_one(
+                                {"_id": MIGRATION_ID},
+                                {"$set": {"last_id": last_id, "n_copied": n_copied, "n_skipped": n_skipped}},
+                                upsert = True
+                                )
+            print(f"Copied {n_copied} events")
+
+    if batch:
+        target.insert_many(batch, ordered = False)
+        n_copied += len(batch)
+    if last_id is not None:
+        migrations.update_one(
+                            {"_id": MIGRATION_ID},
+                            {"$set": {"last_id": last_id, "n_copied": n_copied, "n_skipped": n_skipped}},
+                            upsert = True
+                            )
+
+    print(f"Backfill done, {n_copied} events copied, {n_skipped} with unparseable timestamps skipped")
+    if n_expiring:
+        print(f"Warning: {n_expiring} copied events are older than the {FFEATURES_RAW_TTL_DAYS} day TTL of {target.name} and will be deleted by it shortly")
+    return n_copied, n_skipped
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Backfill string-timestamped ffeatures events into the time-series event collection")
+    parser.add_argument('--source', default = 'ffeatures')
+    parser.add_argument('--batch_size', type = int, default = 1000)
+    args = parser.parse_args()
+
+    with open('secrets.yaml') as f:
+        secrets = yaml.load(f, Loader=yaml.FullLoader)
+
+    client = pymongo.MongoClient(os.environ.get("MONGO_DB_URI", secrets['MONGO_DB_URI']))
+    backfill_ffeatures(client['Elearning'], source_name = args.source, batch_size = args.batch_size)